@@ -0,0 +1,140 @@
+import ast
+import time
+from typing import Iterable, Iterator, NamedTuple
+from uuid import UUID
+
+from app.models import Statechart
+from app.models.statechart import State
+from app.utils import get_current_bot, get_logger, get_repository
+
+__all__ = ["Timer", "StatechartAnalysis", "get_analysis", "can_user_react"]
+
+logger = get_logger(__file__)
+repo = get_repository()
+
+# the event the users are woken up with
+CLOCK_EVENT = "clock"
+
+
+class Timer(NamedTuple):
+    # "after" counts from the entry to the state, "idle" from its last transition
+    kind: str
+    seconds: float
+
+
+def _iterate_states(state: State) -> Iterator[State]:
+    yield state
+    for child in (*state.states, *state.parallel_states):
+        yield from _iterate_states(child)
+
+
+def _find_timers(guard: str | None) -> list[Timer] | None:
+    """The constant timers of a guard, None if they depend on the context"""
+    if not guard:
+        return []
+    try:
+        tree = ast.parse(guard)
+    except SyntaxError:
+        return None
+    timers = []
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in ("after", "idle")
+        ):
+            match node.args:
+                case [ast.Constant(value=int() | float() as seconds)]:
+                    timers.append(Timer(node.func.id, float(seconds)))
+                case _:
+                    return None
+    return timers
+
+
+class StatechartAnalysis:
+    """
+    What the clock can trigger in each state: the timed transitions with their
+    delays, and the states which have to be polled as their timing is unknown.
+    """
+
+    def __init__(self, statechart: Statechart):
+        self.timers: dict[str, list[Timer]] = {}
+        self.polled: set[str] = set()
+        # the states with transitions on the event, None for the eventless ones
+        self.handlers: dict[str | None, set[str]] = {}
+        for state in _iterate_states(statechart.code.root_state):
+            for transition in state.transitions:
+                self.handlers.setdefault(transition.event, set()).add(state.name)
+                if transition.event not in (None, CLOCK_EVENT):
+                    continue
+                timers = _find_timers(transition.guard)
+                if timers:
+                    self.timers.setdefault(state.name, []).extend(timers)
+                elif timers is None or transition.guard or transition.event:
+                    # the guard may depend on anything, so it is checked on schedule
+                    self.polled.add(state.name)
+
+    def can_react(self, configuration: Iterable[str], event: str) -> bool:
+        """Whether any of the active states has a transition the event can trigger"""
+        handlers = self.handlers.get(event, set()) | self.handlers.get(None, set())
+        return not handlers.isdisjoint(configuration)
+
+    def get_next_wakeup(self, interpreter) -> float | None:
+        """The earliest time the clock could change anything for the interpreter"""
+        now = time.time()
+        poll_time = now + get_current_bot().user_clock_interval.total_seconds()
+        times = []
+        for state in interpreter.configuration:
+            if state in self.polled:
+                times.append(poll_time)
+            for timer in self.timers.get(state, ()):
+                if timer.kind == "after":
+                    start = interpreter._entry_time.get(state)
+                else:
+                    start = interpreter._idle_time.get(state)
+                if start is None:
+                    continue
+                # the other conditions of the guard might have held it back
+                deadline = start + timer.seconds
+                times.append(deadline if deadline > now else poll_time)
+        # the delayed events
+        for queue in (interpreter._internal_queue, interpreter._external_queue):
+            if queue:
+                times.append(max(queue[0][0], now))
+        return min(times, default=None)
+
+
+_analyses: dict[UUID, StatechartAnalysis] = {}
+
+
+def get_analysis(statechart: Statechart) -> StatechartAnalysis:
+    if (analysis := _analyses.get(statechart.id)) is None:
+        analysis = _analyses[statechart.id] = StatechartAnalysis(statechart)
+    return analysis
+
+
+async def can_user_react(telegram_id: int, event: str) -> bool:
+    """
+    Checks the configuration persisted after the last dispatch, so the users who
+    would ignore the event are skipped without loading their caches.
+    """
+    if (configuration := await repo.get_user_configuration(telegram_id)) is None:
+        return True
+    if configuration["has_queued_events"]:
+        return True
+    statechart_id = UUID(configuration["statechart"])
+    if (analysis := _analyses.get(statechart_id)) is None:
+        if (statechart := await repo.statecharts.get(statechart_id)) is None:
+            return True
+        analysis = get_analysis(statechart)
+    return analysis.can_react(configuration["states"], event)
+
+
+async def _on_statechart_invalidated(statechart_id: str | None):
+    if statechart_id is None:
+        _analyses.clear()
+    else:
+        _analyses.pop(UUID(statechart_id), None)
+
+
+repo.on_invalidate("statechart", _on_statechart_invalidated)
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+from functools import partial
 from typing import Any
 
 import sismic.model
@@ -8,26 +9,31 @@ from telegram.ext import Application
 
 from app.engine.core import BaseEvaluator, BaseInterpreter
 from app.models import Statechart
-from app.utils import get_logger, get_repository, get_settings
+from app.utils import get_current_bot, get_logger, get_repository
 
 __all__ = ["BotEvaluator", "BotInterpreter"]
 
 logger = get_logger(__file__)
-settings = get_settings()
 repo = get_repository()
 
 
 class BotEvaluator(BaseEvaluator):
     async def _get_shared_context(self) -> dict[str, Any]:
+        import app.engine.logic as logic
+
         interpreter: BotInterpreter = self._interpreter
-        return {"bot": interpreter.app.bot, "repo": repo}
+        return {
+            "bot": interpreter.app.bot,
+            "repo": repo,
+            "render_profiles": partial(logic.render_user_profiles, repo),
+        }
 
 
 class BotInterpreter(BaseInterpreter):
     def __init__(self, app: Application, statechart: Statechart):
         super().__init__(statechart, evaluator_klass=BotEvaluator)
         self.app = app
-        self._clock_interval = settings.bot.bot_clock_interval
+        self._clock_interval = get_current_bot().bot_clock_interval
         self._last_activity_time = datetime.datetime.min
         self._is_active = False
 
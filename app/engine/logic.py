@@ -2,11 +2,11 @@ import asyncio
 from typing import Any
 from uuid import UUID
 
-from jinja2 import DictLoader, Environment
 from sqlalchemy.dialects.postgresql import Range
 from telegram import Chat, Document, InlineKeyboardButton, Message, PhotoSize
 from telegram.ext import Application
 
+from app.engine.templates import AnalysedTemplate, get_template, helpers_variable
 from app.exceptions import ValidationError
 from app.models import (
     Answer,
@@ -17,23 +17,33 @@ from app.models import (
     ContentValidator,
     User,
 )
-from app.profile import get_profile
+from app.profile import (
+    ProfileSession,
+    get_profile_card,
+    is_profile_clean,
+    profile_buffer,
+    set_profile_card,
+)
 from app.repository import Repository
-from app.utils import get_logger
+from app.utils import get_logger, get_settings
 
 __all__ = [
     "get_answer",
     "expect",
     "release",
+    "create_inline_button",
     "make_inline_button",
     "clean_input",
     "save_answer",
     "render_template",
     "get_chat",
     "get_user_profile",
+    "get_user_profiles",
+    "render_user_profiles",
 ]
 
 logger = get_logger(__file__)
+settings = get_settings()
 
 
 async def get_answer(
@@ -87,17 +97,24 @@ def release(cache: Cache, *names: str):
         cache.inputs.pop(name, None)
 
 
-async def make_inline_button(
-    cache: Cache, repo: Repository, name: str, **kwargs
-) -> InlineKeyboardButton:
+def create_inline_button(
+    cache: Cache, name: str, **kwargs
+) -> tuple[InlineKeyboardButton, Callback]:
     callback = Callback(
         state_id=cache.id,
         user_telegram_id=cache.user.telegram_id,
         data=kwargs.pop("data", name),
         **kwargs,
     )
+    return InlineKeyboardButton(name, callback_data=str(callback.id)), callback
+
+
+async def make_inline_button(
+    cache: Cache, repo: Repository, name: str, **kwargs
+) -> InlineKeyboardButton:
+    button, callback = create_inline_button(cache, name, **kwargs)
     await repo.callbacks.save(callback)
-    return InlineKeyboardButton(name, callback_data=str(callback.id))
+    return button
 
 
 async def clean_input(
@@ -135,13 +152,19 @@ async def clean_input(
 async def save_answer(cache: Cache, repo: Repository):
     data = await get_answer(cache, cache.question.label)
     cache.answers[cache.question.label] = data
+    # the keyboards of the question are not needed anymore
+    await repo.callbacks.clear(cache.id, question_id=cache.question.id)
     if trait := cache.question.user_trait:
         if (value := data["value"]) is not None:
             if trait.type is ContentType.DATE_RANGE:
                 value = Range(**value)
             elif trait.type is ContentType.NUMBER_RANGE:
                 value = Range(**value)
-        setattr(cache.profile, trait.column, value)
+        profile = await cache.profile.load()
+        if settings.profile_write_behind:
+            profile_buffer.write(profile, trait.column, value)
+        else:
+            setattr(profile, trait.column, value)
         selected_options = [
             opt.id for opt in cache.selected_options.values() if not opt.is_dynamic
         ]
@@ -159,48 +182,89 @@ async def save_answer(cache: Cache, repo: Repository):
             selected_options=selected_options,
             created_options=created_options,
         )
-        asyncio.create_task(repo.answers.create(answer))
+        await repo.answers.enqueue(answer)
     return data
 
 
 async def get_user_profile(cache: Cache, repo: Repository, user: User):
+    if user.id == cache.user.id:
+        return await cache.profile.load()
     role = await repo.roles.get(user.role)
-    return get_profile(cache.session, role.label, user.id)
+    return await cache.session.get(role.label, user.id)
 
 
-async def render_template(
-    cache: Cache, repo: Repository, template_: str, is_extended: bool = False, **kwargs
-) -> str | dict:
-    loader = DictLoader({"__template__": template_})
-    environment = Environment(
-        loader=loader, extensions=["jinja2.ext.do"], enable_async=True
-    )
-    context = {
-        "cache": cache,
-        "user": cache.user,
-        "answers": cache.answers,
-        "profile": cache.profile,
-        **cache.context,
-        **kwargs,
-    }
+async def get_user_profiles(
+    session: ProfileSession, repo: Repository, users: list[User]
+) -> dict[UUID, Any]:
+    role_ids = {user.role for user in users}
+    roles = await asyncio.gather(*(repo.roles.get(role_id) for role_id in role_ids))
+    labels = {role.id: role.label for role in roles}
+    user_ids_by_role: dict[str, list[UUID]] = {}
+    for user in users:
+        user_ids_by_role.setdefault(labels[user.role], []).append(user.id)
+    return await session.get_many(user_ids_by_role)
+
 
-    photos: list[str] = []
+class TemplateHelpers:
+    """The filters of a single render, they are passed through the context"""
 
-    async def render_photo(photo: str):
+    def __init__(self, cache: Cache | None, repo: Repository):
+        # there is no cache outside the users' dispatches, e.g. in the bot logic
+        self.cache = cache
+        self.repo = repo
+        self.photos: list[str] = []
+        # resolved before rendering, see prefetch
+        self._questions: dict[str, Any] = {}
+        self._contents: dict[UUID, Any] = {}
+
+    async def prefetch(self, template: AnalysedTemplate, context: dict):
+        """Fetch the questions and contents used by the filters concurrently"""
+        labels = [
+            label for label in template.question_labels if label not in self._questions
+        ]
+        content_ids = set()
+        for photo in template.resolve_photos(context):
+            try:
+                content_ids.add(UUID(photo))
+            except ValueError:
+                pass
+        content_ids = [id_ for id_ in content_ids if id_ not in self._contents]
+        if not labels and not content_ids:
+            return
+        results = await asyncio.gather(
+            *(self.repo.questions.get(label=label) for label in labels),
+            *(self.repo.contents.get(id_) for id_ in content_ids),
+            return_exceptions=True,
+        )
+        # the failed lookups are repeated by the filters, if they are reached at all
+        for label, question in zip(labels, results[: len(labels)]):
+            if not isinstance(question, Exception):
+                self._questions[label] = question
+        for id_, content in zip(content_ids, results[len(labels) :]):
+            if not isinstance(content, Exception):
+                self._contents[id_] = content
+
+    async def render_photo(self, photo: str):
         if not photo:
             return ""
         try:
             content_id = UUID(photo)
         except ValueError:
-            photos.append(photo)
+            self.photos.append(photo)
         else:
-            content = await repo.contents.get(content_id)
+            if content_id in self._contents:
+                content = self._contents[content_id]
+            else:
+                content = await self.repo.contents.get(content_id)
             if content and (value := content.value):
-                photos.append(value)
+                self.photos.append(value)
         return ""
 
-    async def to_answer(value: Any, label: str) -> dict:
-        question = await repo.questions.get(label=label)
+    async def to_answer(self, value: Any, label: str) -> dict:
+        if label in self._questions:
+            question = self._questions[label]
+        else:
+            question = await self.repo.questions.get(label=label)
         values = set(value if isinstance(value, list) else [value])
         selected_options = [
             opt for opt in question.options if opt.content.value in values
@@ -218,28 +282,62 @@ async def render_template(
             answer = {k: next(iter(v), None) for k, v in answer.items()}
         return answer
 
-    async def render_profile(user: User, profile) -> str:
-        role = await repo.roles.get(user.role)
-        profile_template = environment.from_string(role.profile_template)
-        render_context = {"user": user, "profile": profile}
-        return await profile_template.render_async(render_context)
+    async def render_profile(self, user: User, profile) -> str:
+        role = await self.repo.roles.get(user.role)
+        source = role.profile_template
+        # the user's own profile is often being edited, so only the others are cached
+        is_own = self.cache is not None and user.id == self.cache.user.id
+        is_cacheable = not is_own and is_profile_clean(profile)
+        if is_cacheable and (card := await get_profile_card(user, profile, source)):
+            text, photos = card
+            self.photos.extend(photos)
+            return text
+        profile_template = get_template(source)
+        render_context = {"user": user, "profile": profile, helpers_variable: self}
+        await self.prefetch(profile_template, render_context)
+        photos_count = len(self.photos)
+        text = await profile_template.render_async(render_context)
+        if is_cacheable:
+            photos = self.photos[photos_count:]
+            await set_profile_card(user, profile, source, text, photos)
+        return text
 
-    async def render(obj: Any) -> str:
+    async def render(self, obj: Any) -> str | list[str]:
+        cache, repo = self.cache, self.repo
+        if isinstance(obj, (list, tuple)) and all(isinstance(o, User) for o in obj):
+            profiles = await get_user_profiles(cache.session, repo, list(obj))
+            return [await self.render_profile(user, profiles[user.id]) for user in obj]
         if isinstance(obj, User):
-            if obj.id == cache.user.id:
-                profile = cache.profile
-            else:
-                profile = await get_user_profile(cache, repo, obj)
-            return await render_profile(obj, profile)
+            profile = await get_user_profile(cache, repo, obj)
+            return await self.render_profile(obj, profile)
         raise RuntimeError(f"Cannot render a '{type(obj).__name__}'")
 
-    environment.filters["render"] = render
-    environment.filters["render_photo"] = render_photo
-    environment.filters["to_answer"] = to_answer
-    template = environment.get_template("__template__")
+
+async def render_template(
+    cache: Cache, repo: Repository, template_: str, is_extended: bool = False, **kwargs
+) -> str | dict:
+    template = get_template(template_)
+    if template.is_constant:
+        # nothing to render, e.g. most of the option names
+        text = template.format({})
+        return {"text": text} if is_extended else text
+    profile = cache.profile
+    if "profile" in template.variables:
+        profile = await profile.load()
+    helpers = TemplateHelpers(cache, repo)
+    context = {
+        "cache": cache,
+        "user": cache.user,
+        "answers": cache.answers,
+        "profile": profile,
+        **cache.context,
+        **kwargs,
+        helpers_variable: helpers,
+    }
+    await helpers.prefetch(template, context)
     text = await template.render_async(context)
     if is_extended:
-        if photos:
+        if photos := helpers.photos:
             # TODO: support multiple photos
             return {"photo": photos[0], "caption": text}
         else:
@@ -248,6 +346,24 @@ async def render_template(
         return text
 
 
+async def render_user_profiles(repo: Repository, users: list[User]) -> dict[UUID, dict]:
+    """
+    The profile cards of many users outside of their dispatches, e.g. for the
+    notifications, like the extended templates: {"text"} or {"photo", "caption"}
+    """
+    cards = {}
+    async with ProfileSession() as session:
+        profiles = await get_user_profiles(session, repo, users)
+        for user in users:
+            helpers = TemplateHelpers(None, repo)
+            text = await helpers.render_profile(user, profiles[user.id])
+            if photos := helpers.photos:
+                cards[user.id] = {"photo": photos[0], "caption": text}
+            else:
+                cards[user.id] = {"text": text}
+    return cards
+
+
 async def get_chat(app: Application, target: User | int) -> Chat:
     if isinstance(target, User):
         target = target.telegram_id
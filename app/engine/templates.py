@@ -0,0 +1,162 @@
+from functools import lru_cache
+from typing import Any
+
+from jinja2 import Environment, Template, Undefined, meta, nodes, pass_context
+from jinja2.runtime import Context
+
+from app.utils import get_settings
+
+__all__ = ["environment", "get_template", "helpers_variable", "AnalysedTemplate"]
+
+settings = get_settings()
+
+# the helpers of the current render are passed through the context
+helpers_variable = "__helpers__"
+
+environment = Environment(extensions=["jinja2.ext.do"], enable_async=True)
+
+
+def _make_helper_filter(name: str):
+    @pass_context
+    async def helper_filter(context: Context, *args, **kwargs):
+        return await getattr(context[helpers_variable], name)(*args, **kwargs)
+
+    return helper_filter
+
+
+for _name in ("render", "render_photo", "to_answer"):
+    environment.filters[_name] = _make_helper_filter(_name)
+
+# a variable lookup: the name followed by the attribute and item accesses
+Path = tuple[str, tuple[tuple[str, Any], ...]]
+
+
+class _LookupFailed(Exception):
+    pass
+
+
+class AnalysedTemplate:
+    """
+    A template which is analysed once: constant templates are returned as is,
+    the ones with plain variable substitutions are formatted without Jinja.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        ast = environment.parse(source)
+        self.variables: set[str] = meta.find_undeclared_variables(ast)
+        self.parts: list[str | Path] | None = self._get_simple_parts(ast)
+        # the arguments of the helper filters which are known before rendering
+        self.question_labels: set[str] = set()
+        self.photos: list[str | Path] = []
+        self._collect_filter_arguments(ast)
+        self._template: Template | None = None
+
+    @property
+    def is_constant(self) -> bool:
+        return self.parts is not None and all(isinstance(p, str) for p in self.parts)
+
+    @property
+    def is_simple(self) -> bool:
+        return self.parts is not None
+
+    @property
+    def template(self) -> Template:
+        if self._template is None:
+            self._template = environment.from_string(self.source)
+        return self._template
+
+    @classmethod
+    def _get_path(cls, node: nodes.Node) -> Path | None:
+        match node:
+            case nodes.Name(name=name):
+                return name, ()
+            case nodes.Getattr(node=parent, attr=attr):
+                if (path := cls._get_path(parent)) is not None:
+                    return path[0], path[1] + (("attr", attr),)
+            case nodes.Getitem(node=parent, arg=nodes.Const(value=key)):
+                if (path := cls._get_path(parent)) is not None:
+                    return path[0], path[1] + (("item", key),)
+        return None
+
+    @classmethod
+    def _get_simple_parts(cls, ast: nodes.Template) -> list[str | Path] | None:
+        parts = []
+        for node in ast.body:
+            if not isinstance(node, nodes.Output):
+                return None
+            for child in node.nodes:
+                if isinstance(child, nodes.TemplateData):
+                    parts.append(child.data)
+                elif isinstance(child, nodes.Const):
+                    parts.append(str(child.value))
+                elif (path := cls._get_path(child)) is not None:
+                    parts.append(path)
+                else:
+                    return None
+        return parts
+
+    def _collect_filter_arguments(self, ast: nodes.Template):
+        for node in ast.find_all(nodes.Filter):
+            if node.name == "to_answer":
+                # value | to_answer(label)
+                label = next(
+                    (kw.value for kw in node.kwargs if kw.key == "label"),
+                    node.args[0] if node.args else None,
+                )
+                if isinstance(label, nodes.Const) and isinstance(label.value, str):
+                    self.question_labels.add(label.value)
+            elif node.name == "render_photo" and node.node is not None:
+                if isinstance(node.node, nodes.Const):
+                    self.photos.append(str(node.node.value))
+                elif (path := self._get_path(node.node)) is not None:
+                    self.photos.append(path)
+
+    def resolve_photos(self, context: dict) -> list[str]:
+        """The photos which can be resolved from the context before rendering"""
+        photos = []
+        for photo in self.photos:
+            if not isinstance(photo, str):
+                try:
+                    photo = self._resolve(photo, context)
+                except Exception:
+                    # the filter will deal with it while rendering
+                    continue
+            if photo and isinstance(photo, str):
+                photos.append(photo)
+        return photos
+
+    @staticmethod
+    def _resolve(path: Path, context: dict) -> Any:
+        name, lookups = path
+        if name not in context:
+            raise _LookupFailed
+        value = context[name]
+        for kind, key in lookups:
+            if kind == "attr":
+                value = environment.getattr(value, key)
+            else:
+                value = environment.getitem(value, key)
+            if isinstance(value, Undefined):
+                raise _LookupFailed
+        return value
+
+    def format(self, context: dict) -> str:
+        return "".join(
+            part if isinstance(part, str) else str(self._resolve(part, context))
+            for part in self.parts
+        )
+
+    async def render_async(self, context: dict) -> str:
+        if self.parts is not None:
+            try:
+                return self.format(context)
+            except _LookupFailed:
+                # let Jinja handle the undefined values
+                pass
+        return await self.template.render_async(context)
+
+
+@lru_cache(maxsize=settings.template_cache_size)
+def get_template(source: str) -> AnalysedTemplate:
+    return AnalysedTemplate(source)
@@ -1,12 +1,14 @@
 from functools import partial
-from typing import Any
+from typing import Any, Mapping
 
+import sismic.model
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ParseMode
 from telegram.ext import Application
 
 from app.engine.core import BaseEvaluator, BaseInterpreter
 from app.models import Cache, Question, Role, Statechart
+from app.profile import references_profile
 from app.repository import Repository
 from app.utils import get_logger
 
@@ -27,6 +29,23 @@ class UserEvaluator(BaseEvaluator):
             **{key: getattr(models, key) for key in models.__all__},
         }
 
+    async def _load_profile(self, code: str | None):
+        # the profile is loaded lazily, so it has to be ready before the code runs
+        if references_profile(code):
+            await self._interpreter.cache.profile.load()
+
+    async def _execute_code(
+        self, code: str | None, *, additional_context: Mapping[str, Any] = None
+    ) -> list[sismic.model.Event]:
+        await self._load_profile(code)
+        return await super()._execute_code(code, additional_context=additional_context)
+
+    async def _evaluate_code(
+        self, code: str | None, *, additional_context: Mapping[str, Any] = None
+    ) -> bool:
+        await self._load_profile(code)
+        return await super()._evaluate_code(code, additional_context=additional_context)
+
     async def _get_shared_context(self) -> dict[str, Any]:
         import app.engine.logic as logic
         from app.questions import QuestionManager
@@ -68,6 +87,9 @@ class UserEvaluator(BaseEvaluator):
             "get_question_manager": lambda: QuestionManager(cache, repo),
             "get_chat": partial(logic.get_chat, interpreter.app),
             "get_profile": partial(logic.get_user_profile, cache, repo),
+            "get_profiles": lambda users: logic.get_user_profiles(
+                cache.session, repo, users
+            ),
         }
 
 
@@ -82,6 +104,7 @@ class UserInterpreter(BaseInterpreter):
         repo: Repository,
     ):
         super().__init__(statechart, evaluator_klass=UserEvaluator)
+        self.statechart_model = statechart
         self.cache = cache
         self.role = role
         self.app = app
@@ -9,7 +9,8 @@ from pydantic import PrivateAttr
 from app.integrations.mq.schemas import RedisMessage
 from app.integrations.utils import get_cache
 from app.interfaces import Application, Bot, Chat
-from app.utils import get_logger, get_repository, get_settings
+from app.profile import profile_buffer
+from app.utils import activate_bot, get_logger, get_repository, get_settings
 
 logger = get_logger(__file__)
 settings = get_settings()
@@ -172,10 +173,13 @@ class MqApplication(Application):
 
 async def main():
     logger.info("Initializing the message queue...")
-    settings.bot = await repo.bots.get(settings.bot_id)
-    logger.info("Using the following settings: ")
-    logger.info(settings)
+    runtime = await activate_bot(settings.single_bot_id)
+    logger.info(f"Serving the bot @{runtime.config.username}")
     logger.info("Message queue has started UwU")
     application = MqApplication()
+    invalidations = asyncio.create_task(repo.listen_for_invalidations())
     await application.bot.run()
+    invalidations.cancel()
+    await repo.answers.close()
+    await profile_buffer.close()
     logger.info("Message queue has stopped")
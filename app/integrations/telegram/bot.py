@@ -0,0 +1,243 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Awaitable, Callable, Coroutine, Type, TypeVar
+
+from telegram import Chat, File, Message, TelegramObject, UserProfilePhotos
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import BaseRateLimiter, ExtBot
+from telegram.request import HTTPXRequest
+
+from app.utils import get_logger, get_repository, get_settings
+
+__all__ = ["PriorityRateLimiter", "TelegramBot"]
+
+logger = get_logger(__file__)
+settings = get_settings()
+repo = get_repository()
+
+TelegramObjectClass = TypeVar("TelegramObjectClass", bound=TelegramObject)
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# the errors of the stale or foreign file ids, unlike e.g. a too long caption
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+)
+
+
+class _Bucket:
+    """A token bucket in the form of the generic cell rate algorithm"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate
+        self.tolerance = self.interval * (burst - 1)
+        # the theoretical arrival time of the next request
+        self.tat = 0.0
+
+    def delay(self) -> float:
+        return max(0.0, self.tat - self.tolerance - time.monotonic())
+
+    def reserve(self) -> float:
+        """Take the next slot, returns how long to wait for it"""
+        now = time.monotonic()
+        tat = max(self.tat, now)
+        self.tat = tat + self.interval
+        return max(0.0, tat - self.tolerance - now)
+
+
+class PriorityRateLimiter(BaseRateLimiter[dict]):
+    """
+    Keeps the requests within the global limit of Telegram, and the requests to
+    the groups within the per-group one as well. The interactive requests reserve
+    their slots right away, the bulk ones (rate_limit_args={"priority": "bulk"})
+    wait until no interactive request is waiting. A RetryAfter pauses all the
+    requests and the request is retried.
+    """
+
+    max_chat_buckets = 10_000
+
+    def __init__(self):
+        self._global = _Bucket(settings.telegram_global_rate)
+        self._chats: dict[int | str, _Bucket] = {}
+        self._interactive_waiting = 0
+        self._retry_until = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _get_group_bucket(self, chat_id: int | str) -> _Bucket | None:
+        if not isinstance(chat_id, str) and chat_id >= 0:
+            # a private chat
+            return None
+        if (bucket := self._chats.get(chat_id)) is None:
+            if len(self._chats) >= self.max_chat_buckets:
+                # the idle buckets are full, so they can be recreated at any time
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if b.tat > now}
+            # the groups are limited to 20 messages a minute
+            bucket = self._chats[chat_id] = _Bucket(
+                settings.telegram_group_rate, settings.telegram_group_burst
+            )
+        return bucket
+
+    async def _wait_for_retry(self):
+        while (delay := self._retry_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def _acquire(self, chat_id: int | str | None, priority: str):
+        await self._wait_for_retry()
+        if chat_id is not None and (bucket := self._get_group_bucket(chat_id)):
+            await asyncio.sleep(bucket.reserve())
+        if priority != BULK:
+            self._interactive_waiting += 1
+            try:
+                await asyncio.sleep(self._global.reserve())
+            finally:
+                self._interactive_waiting -= 1
+            return
+        while self._interactive_waiting or (delay := self._global.delay()) > 0:
+            await asyncio.sleep(
+                self._global.interval if self._interactive_waiting else delay
+            )
+        self._global.reserve()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | dict | list[dict]]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: dict | None,
+    ) -> bool | dict | list[dict]:
+        chat_id = data.get("chat_id")
+        if chat_id is None and "chat_id" not in data:
+            # getMe, getFile, answerCallbackQuery and the like are not limited
+            return await callback(*args, **kwargs)
+        priority = (rate_limit_args or {}).get("priority", INTERACTIVE)
+        for attempt in range(settings.telegram_max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == settings.telegram_max_retries:
+                    raise
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"{endpoint} is rate limited for {retry_after}s")
+                self._retry_until = max(
+                    self._retry_until, time.monotonic() + retry_after
+                )
+
+
+class TelegramBot(ExtBot):
+    """
+    The bot with the outbound rate limits, the batch sending, the lookups cached
+    in redis and the photos resent by their file ids.
+    """
+
+    def __init__(self, token: str):
+        super().__init__(
+            token,
+            rate_limiter=PriorityRateLimiter(),
+            request=HTTPXRequest(connection_pool_size=settings.concurrent_updates),
+        )
+
+    async def send_batch(
+        self, messages: list[dict], *, priority: str = BULK
+    ) -> list[Any | Exception]:
+        """
+        Send the messages concurrently, the rate limiter orders them. A message is
+        either {"chat_id", "text", ...} or {"chat_id", "photo", "caption", ...}.
+        """
+
+        async def send(message: dict):
+            send_ = self.send_photo if "photo" in message else self.send_message
+            return await send_(**message, rate_limit_args={"priority": priority})
+
+        return await asyncio.gather(*map(send, messages), return_exceptions=True)
+
+    async def _get_cached(
+        self,
+        key: str,
+        ex: int,
+        class_: Type[TelegramObjectClass],
+        fetch: Callable[[], Awaitable[TelegramObjectClass]],
+    ) -> TelegramObjectClass:
+        if data := await repo.db.get(key):
+            return class_.de_json(json.loads(data), self)
+        obj = await fetch()
+        await repo.db.set(key, obj.to_json(), ex=ex)
+        return obj
+
+    async def get_chat(self, chat_id: int | str, **kwargs) -> Chat:
+        # the bots see the chats differently, e.g. the ids of the photos
+        return await self._get_cached(
+            f"telegram:chat[{self.id}:{chat_id}]",
+            settings.cache_ex_telegram_chat,
+            Chat,
+            lambda: super(TelegramBot, self).get_chat(chat_id, **kwargs),
+        )
+
+    async def get_user_profile_photos(
+        self,
+        user_id: int,
+        offset: int | None = None,
+        limit: int | None = None,
+        **kwargs,
+    ) -> UserProfilePhotos:
+        return await self._get_cached(
+            f"telegram:photos[{self.id}:{user_id}]:{offset}:{limit}",
+            settings.cache_ex_telegram_chat,
+            UserProfilePhotos,
+            lambda: super(TelegramBot, self).get_user_profile_photos(
+                user_id, offset, limit, **kwargs
+            ),
+        )
+
+    async def get_file(self, file_id: str, **kwargs) -> File:
+        # the file ids are specific to the bot, unlike the unique ids
+        return await self._get_cached(
+            f"telegram:file[{self.id}:{file_id}]",
+            settings.cache_ex_telegram_file,
+            File,
+            lambda: super(TelegramBot, self).get_file(file_id, **kwargs),
+        )
+
+    def _make_photo_key(self, photo: Any) -> str | None:
+        if isinstance(photo, str) and photo.startswith(("http://", "https://")):
+            digest = hashlib.sha1(photo.encode()).hexdigest()
+        elif isinstance(photo, bytes):
+            digest = hashlib.sha1(photo).hexdigest()
+        else:
+            # the file ids, the paths and the file objects are sent as they are
+            return None
+        return f"telegram:photo[{self.id}:{digest}]"
+
+    async def send_photo(self, chat_id: int | str, photo: Any, *args, **kwargs):
+        """Send the photos uploaded once already by their file ids"""
+        if (key := self._make_photo_key(photo)) is None:
+            return await super().send_photo(chat_id, photo, *args, **kwargs)
+        if file_id := await repo.db.get(key):
+            try:
+                return await super().send_photo(chat_id, file_id, *args, **kwargs)
+            except BadRequest as e:
+                if not any(error in e.message.lower() for error in FILE_ID_ERRORS):
+                    raise
+                logger.warning(f"the cached photo {file_id} is rejected: {e}")
+                await repo.db.delete(key)
+        message: Message = await super().send_photo(chat_id, photo, *args, **kwargs)
+        if message.photo:
+            file_id = message.photo[-1].file_id
+            await repo.db.set(key, file_id, ex=settings.cache_ex_telegram_photo)
+        return message
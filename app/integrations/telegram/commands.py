@@ -6,15 +6,15 @@ import json
 import jinja2
 import telegram
 from pydantic.json import pydantic_encoder
-from sqlalchemy import Column, Table, text
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
 from app.engine.logic import render_template
 from app.integrations.telegram.utils import modifies_state
+from app.integrations.utils import lock_user
 from app.models import Cache
-from app.profile import Session, content_type_to_column, get_profile_class
+from app.profile import apply_profile_schema, plan_profile_schema
 from app.utils import get_logger, get_repository, get_settings
 
 __all__ = [
@@ -31,12 +31,15 @@ repo = get_repository()
 
 
 async def reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    cache = await repo.caches.load_for_user(
-        update.effective_user.id, context.application
-    )
-    await repo.states.delete(cache.user.state)
-    await repo.users.remove(cache.user)
-    await repo.caches.remove(cache)
+    telegram_id = update.effective_user.id
+    async with lock_user(telegram_id):
+        cache = await repo.caches.load_for_user(telegram_id, context.application)
+        await repo.states.delete(cache.user.state)
+        await repo.callbacks.clear_state(cache.id)
+        await repo.users.remove(cache.user)
+        await repo.caches.remove(cache)
+        await repo.schedule_user_wakeup(telegram_id, None)
+        await repo.remove_user_configuration(telegram_id)
     await update.message.reply_text("done")
 
 
@@ -78,37 +81,17 @@ async def sync_database(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("No roles found")
         return
 
-    def add_column(table_name_, column_):
-        # column_name_ = column_.compile(dialect=session.bind.dialect)
-        column_type_ = column_.type.compile(session.bind.dialect)
-        # TODO: prevent possible sql injections? use alembic instead?
-        session.execute(
-            text(
-                'ALTER TABLE "%s" ADD COLUMN "%s" %s'
-                % (table_name_, column_.name, column_type_)
-            )
-        )
-
-    with Session.begin() as session:
-        for role in roles:
-            profile_class = get_profile_class(role.label)
-            stats = f"{role.name} ({session.query(profile_class).count()} objects): \n"
-            for trait in role.traits:
-                table: Table = profile_class.__table__
-                column_name = trait.column
-                is_new = False
-                if column_name not in table.columns.keys():
-                    is_new = True
-                    logger.info(
-                        f"Adding column {column_name!r} to the {table.name!r} table"
-                    )
-                    type_ = content_type_to_column[trait.type]
-                    column = Column(column_name, type_, nullable=True)
-                    table.append_column(column)
-                    add_column(table.name, column)
-                sign = "+" if is_new else "-"
-                stats += f"  {sign} {column_name} ({trait.type.value})\n"
-            await update.message.reply_text(stats)
+    plans = await plan_profile_schema(roles)
+    errors = await apply_profile_schema(plans)
+    for plan in plans:
+        count = "?" if plan.estimated_rows is None else f"~{plan.estimated_rows}"
+        stats = f"{plan.role.name} ({count} objects): \n"
+        for trait in plan.role.traits:
+            sign = "+" if trait in plan.missing_traits else "-"
+            stats += f"  {sign} {trait.column} ({trait.type.value})\n"
+        if error := errors.get(plan.table_name):
+            stats += f"Could not add the columns: {error}"
+        await update.message.reply_text(stats)
 
 
 @modifies_state
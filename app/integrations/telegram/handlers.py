@@ -48,7 +48,10 @@ async def handle_callback_query(
     cache: Cache,
 ) -> None:
     query = update.callback_query
-    if callback := await repo.callbacks.load(query.data):
+    question_id = cache.question and cache.question.id
+    if callback := await repo.callbacks.load(
+        query.data, state_id=cache.id, question_id=question_id
+    ):
         if callback.auto_answer:
             await query.answer()
         cache.interpreter.context.update(query=query, callback=callback)
@@ -1,9 +1,12 @@
 import asyncio
 import datetime
+import signal
+import time
 from functools import partial
 from uuid import UUID
 
 import telegram
+from aiolimiter import AsyncLimiter
 from telegram.constants import ChatAction
 from telegram.ext import (
     Application,
@@ -16,8 +19,20 @@ from telegram.ext import (
 
 import app.integrations.telegram.commands as commands
 import app.integrations.telegram.handlers as handlers
+from app.integrations.telegram.bot import TelegramBot
+from app.engine.analysis import can_user_react
 from app.integrations.utils import get_cache
-from app.utils import get_logger, get_repository, get_settings
+from app.models import User
+from app.profile import profile_buffer
+from app.utils import (
+    BotRuntime,
+    activate_bot,
+    get_bot_runtime,
+    get_current_bot,
+    get_logger,
+    get_repository,
+    get_settings,
+)
 
 logger = get_logger(__file__)
 settings = get_settings()
@@ -37,7 +52,7 @@ async def run_bot_logic(app: Application, *, update_trigger: asyncio.Event):
         await update_trigger.wait()
         update_trigger.clear()
         old_statechart_id = statechart_id
-        statechart_id = settings.bot.statechart
+        statechart_id = get_current_bot().statechart
         if statechart_id == old_statechart_id:
             continue
         if task:
@@ -50,63 +65,170 @@ async def run_bot_logic(app: Application, *, update_trigger: asyncio.Event):
             task = asyncio.create_task(engine.run())
 
 
+async def refresh_bot_config(runtime: BotRuntime, trigger: asyncio.Event):
+    if bot := await repo.bots.get(runtime.id):
+        # in place, the tasks of the bot share the runtime
+        runtime.config = bot
+        if not trigger.is_set():
+            trigger.set()
+
+
 async def post_init(app: Application, *, update_trigger: asyncio.Event):
-    asyncio.create_task(run_bot_logic(app, update_trigger=update_trigger))
+    # the listener runs in its own context, so the runtime is captured here
+    runtime = get_bot_runtime()
+
+    async def on_bot_invalidated(bot_id: str | None):
+        if bot_id is None or bot_id == str(runtime.id):
+            await refresh_bot_config(runtime, update_trigger)
+
+    repo.on_invalidate("bot", on_bot_invalidated)
+    repo.start_invalidation_listener()
+    if settings.run_jobs:
+        asyncio.create_task(run_bot_logic(app, update_trigger=update_trigger))
+        asyncio.create_task(run_user_logic(app))
+        if settings.check_user_inactivity and await repo.db.exists(
+            get_bot_runtime().make_key("users:probe:cursor")
+        ):
+            # the probe was interrupted by the restart
+            app.job_queue.run_once(disable_inactive_users, when=0)
     update_trigger.set()
 
 
-async def run_user_logic(context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"running user logic, users={await repo.get_active_user_ids()}")
-    for uid in await repo.get_active_user_ids():
-        async with get_cache(uid, context.application) as cache:
-            await cache.interpreter.dispatch_event("clock")
+async def close_shared_resources():
+    await repo.answers.close()
+    await profile_buffer.close()
 
 
-async def update_bot_config(context: ContextTypes.DEFAULT_TYPE):
-    trigger: asyncio.Event = context.job.data["trigger"]
-    if bot := await repo.bots.get(settings.bot_id):
-        settings.bot = bot
-        if not trigger.is_set():
-            trigger.set()
+async def post_shutdown(app: Application):
+    await close_shared_resources()
 
 
-async def disable_inactive_users(context: ContextTypes.DEFAULT_TYPE):
-    for user in await repo.users.get(is_active=True, many=True):
+async def wake_up_user(app: Application, uid: int, semaphore: asyncio.Semaphore):
+    async with semaphore:
         try:
-            await context.bot.send_chat_action(
-                chat_id=user.telegram_id, action=ChatAction.TYPING
-            )
-        except telegram.error.TelegramError as e:
-            if isinstance(e, telegram.error.Forbidden):
-                user.is_matchable = False
-                await repo.users.patch(user)
-                logger.debug(
-                    f"Deactivated user {user.telegram_id} (typing test: '{e}')"
+            if not await can_user_react(uid, "clock"):
+                # nothing would change, the user is woken up by the next update
+                await repo.schedule_user_wakeup(uid, None)
+                return
+            async with get_cache(uid, app) as cache:
+                await cache.interpreter.dispatch_event("clock")
+        except Exception as e:
+            logger.error(f"could not wake up the user {uid}: {e}")
+
+
+async def run_user_logic(app: Application):
+    """Dispatch the clock to the users whose statecharts have timers due"""
+    await repo.seed_user_wakeups()
+    semaphore = asyncio.Semaphore(settings.scheduler_concurrency)
+    while True:
+        started = time.time()
+        lease = get_current_bot().user_clock_interval.total_seconds()
+        try:
+            # the users rescheduled during this tick wait for the next one
+            while user_ids := await repo.claim_due_user_ids(
+                started, limit=settings.scheduler_batch_size, lease=lease
+            ):
+                logger.debug(f"waking up {len(user_ids)} users")
+                await asyncio.gather(
+                    *(wake_up_user(app, uid, semaphore) for uid in user_ids)
                 )
+        except Exception as e:
+            logger.error(f"could not run the user logic: {e}")
+        await asyncio.sleep(max(0.0, started + settings.scheduler_tick - time.time()))
+
+
+async def update_bot_config(context: ContextTypes.DEFAULT_TYPE):
+    # a safety net, the changes are normally pushed through the invalidation channel
+    await refresh_bot_config(get_bot_runtime(), context.job.data["trigger"])
+
+
+async def probe_user(
+    bot: telegram.Bot,
+    user: User,
+    limiter: AsyncLimiter,
+    semaphore: asyncio.Semaphore,
+) -> bool:
+    """Whether the user has blocked the bot"""
+    async with semaphore:
+        for _ in range(3):
+            async with limiter:
+                try:
+                    await bot.send_chat_action(
+                        chat_id=user.telegram_id,
+                        action=ChatAction.TYPING,
+                        rate_limit_args={"priority": "bulk"},
+                    )
+                except telegram.error.Forbidden as e:
+                    logger.debug(
+                        f"Deactivated user {user.telegram_id} (typing test: '{e}')"
+                    )
+                    return True
+                except telegram.error.RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except telegram.error.TelegramError:
+                    return False
+                return False
+        return False
+
+
+async def disable_inactive_users(context: ContextTypes.DEFAULT_TYPE):
+    # the offset of the next page, so that a restarted probe continues from it
+    cursor_key = get_bot_runtime().make_key("users:probe:cursor")
+    offset = int(await repo.db.get(cursor_key) or 0)
+    limiter = AsyncLimiter(settings.inactivity_probe_rate, 1)
+    semaphore = asyncio.Semaphore(settings.inactivity_probe_concurrency)
+    logger.info(f"probing the users for inactivity from {offset}")
+    async for offset, users in repo.users.iterate(
+        offset=offset, page_size=settings.inactivity_probe_page_size
+    ):
+        blocked = await asyncio.gather(
+            *(probe_user(context.bot, user, limiter, semaphore) for user in users)
+        )
+        if deactivated := [user for user, b in zip(users, blocked) if b]:
+            await repo.users.patch_many(deactivated, is_matchable=False)
+        await repo.db.set(
+            cursor_key,
+            offset + len(users),
+            ex=settings.cache_ex_inactivity_probe_cursor,
+        )
+    await repo.db.delete(cursor_key)
+    logger.info("probing the users for inactivity has finished")
 
 
 async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
 
-async def initialize_bot():
-    logger.info("Initializing the bot...")
-    settings.bot = await repo.bots.get(settings.bot_id)
-    logger.info("Using the following settings: ")
-    logger.info(settings)
-
+async def initialize_bot(bot_id: UUID | None = None) -> BotRuntime:
+    """Serve the bot in the current task, the settings one by default"""
+    bot_id = bot_id or settings.single_bot_id
+    logger.info(f"Initializing the bot {bot_id}...")
+    runtime = await activate_bot(bot_id)
+    logger.info(f"Serving the bot @{runtime.config.username}")
+    return runtime
 
-def main():
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(initialize_bot())
 
+def build_application(*, updater: bool = True, shared: bool = False) -> Application:
+    """
+    The application with the handlers and the jobs, shared by the polling and
+    the webhook entry points. The bot has to be initialized in the current task
+    already, as the handlers and the jobs inherit its runtime from the task.
+    The shared resources are closed by the process instead of the application
+    when it serves several bots.
+    """
     update_trigger = asyncio.Event()
-    app = (
+    builder = (
         Application.builder()
-        .token(settings.bot.token.get_secret_value())
+        .bot(TelegramBot(get_current_bot().token.get_secret_value()))
+        .concurrent_updates(settings.concurrent_updates)
         .post_init(partial(post_init, update_trigger=update_trigger))
-        .build()
     )
+    if not shared:
+        builder = builder.post_shutdown(post_shutdown)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
     app.add_error_handler(handle_error)
     app.add_handlers(
         [
@@ -122,10 +244,9 @@ def main():
             CallbackQueryHandler(handlers.handle_callback_query),
         ]
     )
-    app.job_queue.run_repeating(
-        run_user_logic,
-        interval=settings.bot.user_clock_interval,
-    )
+    if not settings.run_jobs:
+        # another replica runs the statecharts on schedule
+        return app
     app.job_queue.run_repeating(
         update_bot_config,
         interval=settings.cache_ex_bot,
@@ -137,5 +258,62 @@ def main():
             first=settings.check_user_inactivity_time,
             interval=datetime.timedelta(days=1),
         )
-    logger.info("Polling has started UwU")
-    app.run_polling()
+    return app
+
+
+async def start_bot(bot_id: UUID) -> Application:
+    """Start polling for the bot in a task of its own, so that it owns a runtime"""
+
+    async def start() -> Application:
+        await initialize_bot(bot_id)
+        app = build_application(shared=True)
+        await app.initialize()
+        await app.post_init(app)
+        await app.updater.start_polling(allowed_updates=telegram.Update.ALL_TYPES)
+        await app.start()
+        return app
+
+    return await asyncio.create_task(start())
+
+
+async def stop_bot(app: Application):
+    try:
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+    except Exception as e:
+        logger.error(f"could not stop the bot @{app.bot.username}: {e}")
+
+
+async def run_bots():
+    """Serve every configured bot in this process until it is interrupted"""
+    bot_ids = settings.served_bot_ids
+    results = await asyncio.gather(
+        *(start_bot(bot_id) for bot_id in bot_ids), return_exceptions=True
+    )
+    apps = []
+    for bot_id, result in zip(bot_ids, results):
+        # a broken bot does not take the others down
+        if isinstance(result, BaseException):
+            logger.error(f"could not start the bot {bot_id}: {result}")
+        else:
+            apps.append(result)
+    if not apps:
+        raise RuntimeError("None of the bots could be started")
+    logger.info(f"Polling has started for {len(apps)} bots UwU")
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    try:
+        await stopped.wait()
+    finally:
+        await asyncio.gather(*(stop_bot(app) for app in apps))
+        await close_shared_resources()
+
+
+def main():
+    asyncio.run(run_bots())
@@ -12,7 +12,8 @@ from typing import Any
 
 from app.integrations.utils import get_cache
 from app.interfaces import Application, Bot, Chat, Message
-from app.utils import get_logger, get_repository, get_settings
+from app.profile import profile_buffer
+from app.utils import activate_bot, get_logger, get_repository, get_settings
 
 logger = get_logger(__file__)
 settings = get_settings()
@@ -122,9 +123,8 @@ async def handle_update(update: dict, app: TerminalApplication):
 
 async def main():
     logger.info("Initializing the bot...")
-    settings.bot = await repo.bots.get(settings.bot_id)
-    logger.info("Using the following settings: ")
-    logger.info(settings)
+    runtime = await activate_bot(settings.single_bot_id)
+    logger.info(f"Serving the bot @{runtime.config.username}")
     logger.info("Terminal Bot has started UwU")
     application = TerminalApplication()
     while True:
@@ -153,4 +153,6 @@ async def main():
             application.bot.display_all_messages()
         finally:
             application.bot.flush_message_queue()
+    await repo.answers.close()
+    await profile_buffer.close()
     logger.info("Terminal Bot has stopped")
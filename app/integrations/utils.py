@@ -1,35 +1,74 @@
+import asyncio
 import contextlib
+from uuid import UUID
 
 from httpx import HTTPStatusError
 
+from app.engine.analysis import get_analysis
 from app.interfaces import Application
-from app.profile import Session, get_profile
-from app.utils import get_logger, get_repository, get_settings
+from app.profile import LazyProfile, ProfileSession
+from app.utils import get_bot_runtime, get_logger, get_repository, get_settings
 
-__all__ = ["get_cache"]
+__all__ = ["get_cache", "lock_user"]
 
 logger = get_logger(__file__)
 settings = get_settings()
 repo = get_repository()
 
+# the locks are kept only while somebody holds or waits for them, a telegram id
+# is the same user for the different bots only by coincidence
+_user_locks: dict[tuple[UUID, int], asyncio.Lock] = {}
+_user_lock_users: dict[tuple[UUID, int], int] = {}
+
+
+@contextlib.asynccontextmanager
+async def lock_user(telegram_id: int):
+    """Serialize the dispatches of a user, the waiters are served in order"""
+    key = (get_bot_runtime().id, telegram_id)
+    lock = _user_locks.setdefault(key, asyncio.Lock())
+    _user_lock_users[key] = _user_lock_users.get(key, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _user_lock_users[key] -= 1
+        if not _user_lock_users[key]:
+            del _user_lock_users[key]
+            del _user_locks[key]
+
 
 @contextlib.asynccontextmanager
 async def get_cache(telegram_id: int, app: Application):
-    cache = await repo.caches.load_for_user(telegram_id, app)
-    with Session.begin() as session:
-        cache.session = session
-        profile = get_profile(session, cache.interpreter.role.label, cache.user.id)
-        cache.interpreter.context.update(profile=profile)
-        yield cache
-        await repo.caches.save(cache)
-        state = cache.modify_state(await repo.states.get(cache.id))
-        try:
-            await repo.states.patch(state)
-        except HTTPStatusError:
-            await app.bot.send_message(
-                telegram_id, "We've reset your account, so you can start anew"
+    # the quota keeps a busy bot from taking all the shared connections
+    async with lock_user(telegram_id), get_bot_runtime().semaphore:
+        cache = await repo.caches.load_for_user(telegram_id, app)
+        async with ProfileSession() as session:
+            cache.session = session
+            profile = LazyProfile(session, cache.interpreter.role.label, cache.user.id)
+            cache.interpreter.context.update(profile=profile)
+            yield cache
+            interpreter = cache.interpreter
+            wakeup = get_analysis(interpreter.statechart_model).get_next_wakeup(
+                interpreter
             )
-            await repo.users.remove(cache.user)
-        else:
-            await repo.users.patch(cache.user)
-        cache.session = None
+            await repo.schedule_user_wakeup(telegram_id, wakeup)
+            configuration = {
+                "statechart": str(interpreter.statechart_model.id),
+                "states": list(interpreter.configuration),
+                "has_queued_events": bool(
+                    interpreter._internal_queue or interpreter._external_queue
+                ),
+            }
+            await repo.save_user_configuration(telegram_id, configuration)
+            await repo.caches.save(cache)
+            state = cache.modify_state(await repo.states.get(cache.id))
+            try:
+                await repo.states.patch(state)
+            except HTTPStatusError:
+                await app.bot.send_message(
+                    telegram_id, "We've reset your account, so you can start anew"
+                )
+                await repo.users.remove(cache.user)
+            else:
+                await repo.users.patch(cache.user)
+            cache.session = None
@@ -0,0 +1,198 @@
+# Webhook integration
+# Telegram posts the updates to settings.webhook_url, which has to be routed to
+# settings.webhook_path of this server, e.g. by nginx terminating SSL. When the
+# server hosts several bots (BOT_IDS), each of them gets the bot id appended to
+# both, e.g. https://example.com/telegram/<bot_id>:
+#
+# services:
+#   engine:
+#     entrypoint: [ "python", "-m", "app.integrations.webhook" ]
+#
+# Several replicas can run behind a load balancer, RUN_JOBS should be enabled
+# for one of them only. See sender.py for a local load test.
+import asyncio
+import contextlib
+import secrets
+from uuid import UUID
+
+import uvicorn
+from fastapi import FastAPI, Request, Response, status
+from telegram import Update
+from telegram.ext import Application
+
+from app.integrations.telegram.main import (
+    build_application,
+    close_shared_resources,
+    initialize_bot,
+)
+from app.utils import get_logger, get_settings
+
+__all__ = ["UpdateQueue", "api", "main"]
+
+logger = get_logger(__file__)
+settings = get_settings()
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateQueue:
+    """
+    Decouples the HTTP requests from the processing: the updates are acknowledged
+    as soon as they are queued, and a fixed number of workers process them.
+    """
+
+    def __init__(self, application: Application):
+        self.application = application
+        self._queue: asyncio.Queue[Update] = asyncio.Queue(
+            maxsize=settings.webhook_queue_size
+        )
+        self._workers: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def put(self, update: Update) -> bool:
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _work(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"could not process the update {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def start(self):
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(settings.webhook_workers)
+        ]
+
+    async def stop(self):
+        # the acknowledged updates are processed before shutting down
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(
+                self._queue.join(), timeout=settings.webhook_drain_timeout
+            )
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+def _make_webhook_url(bot_id: UUID) -> str:
+    url = str(settings.webhook_url)
+    if len(settings.served_bot_ids) == 1:
+        return url
+    return f"{url.rstrip('/')}/{bot_id}"
+
+
+async def start_bot(bot_id: UUID) -> UpdateQueue:
+    """Start the bot in a task of its own, the workers inherit its runtime"""
+
+    async def start() -> UpdateQueue:
+        await initialize_bot(bot_id)
+        application = build_application(updater=False, shared=True)
+        queue = UpdateQueue(application)
+        await application.initialize()
+        await application.post_init(application)
+        await application.start()
+        queue.start()
+        if settings.webhook_url:
+            secret = settings.webhook_secret
+            await application.bot.set_webhook(
+                url=_make_webhook_url(bot_id),
+                secret_token=secret and secret.get_secret_value(),
+                allowed_updates=Update.ALL_TYPES,
+            )
+        return queue
+
+    return await asyncio.create_task(start())
+
+
+async def stop_bot(queue: UpdateQueue):
+    try:
+        await queue.stop()
+        await queue.application.stop()
+        await queue.application.shutdown()
+    except Exception as e:
+        logger.error(f"could not stop the bot @{queue.application.bot.username}: {e}")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(api_: FastAPI):
+    bot_ids = settings.served_bot_ids
+    results = await asyncio.gather(
+        *(start_bot(bot_id) for bot_id in bot_ids), return_exceptions=True
+    )
+    queues: dict[UUID, UpdateQueue] = {}
+    for bot_id, result in zip(bot_ids, results):
+        # a broken bot does not take the others down
+        if isinstance(result, BaseException):
+            logger.error(f"could not start the bot {bot_id}: {result}")
+        else:
+            queues[bot_id] = result
+    if not queues:
+        raise RuntimeError("None of the bots could be started")
+    api_.state.queues = queues
+    logger.info(f"Webhook has started for {len(queues)} bots UwU")
+    yield
+    await asyncio.gather(*(stop_bot(queue) for queue in queues.values()))
+    await close_shared_resources()
+
+
+api = FastAPI(lifespan=lifespan)
+
+
+async def _receive_update(request: Request, queue: UpdateQueue | None) -> Response:
+    if secret := settings.webhook_secret:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not secrets.compare_digest(token, secret.get_secret_value()):
+            return Response(status_code=status.HTTP_403_FORBIDDEN)
+    if queue is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+    update = Update.de_json(await request.json(), queue.application.bot)
+    if not queue.put(update):
+        # Telegram delivers the update again later
+        logger.warning(f"the update queue is full, rejected {update.update_id}")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response(status_code=status.HTTP_200_OK)
+
+
+@api.post(settings.webhook_path)
+async def receive_update(request: Request) -> Response:
+    # the plain path is kept for the servers hosting a single bot
+    queue = None
+    if len(bot_ids := settings.served_bot_ids) == 1:
+        queue = request.app.state.queues.get(bot_ids[0])
+    return await _receive_update(request, queue)
+
+
+@api.post(settings.webhook_path.rstrip("/") + "/{bot_id}")
+async def receive_bot_update(request: Request, bot_id: UUID) -> Response:
+    return await _receive_update(request, request.app.state.queues.get(bot_id))
+
+
+@api.get("/health")
+async def health(request: Request) -> dict:
+    return {
+        "queues": {
+            str(bot_id): queue.depth
+            for bot_id, queue in request.app.state.queues.items()
+        }
+    }
+
+
+def main():
+    uvicorn.run(
+        api,
+        host=settings.webhook_host,
+        port=settings.webhook_port,
+        log_level=settings.log_level.lower(),
+    )
@@ -0,0 +1,95 @@
+# A stand-in for Telegram which posts fake text messages to the webhook:
+#
+# python -m app.integrations.webhook.sender --url http://localhost/telegram \
+#     --users 100 --messages 10 --concurrency 50
+#
+# The chats do not exist, so the replies of the bot fail, but the ingestion,
+# the queue and the dispatches are exercised as usual.
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+
+import httpx
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+FIRST_USER_ID = 10**12
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {
+                "id": user_id,
+                "type": "private",
+                "first_name": user["first_name"],
+            },
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def send(args: argparse.Namespace):
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    update_ids = itertools.count(1)
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(client: httpx.AsyncClient, user_id: int, text: str):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.post(
+                    args.url, json=make_update(next(update_ids), user_id, text)
+                )
+                code = response.status_code
+            except httpx.TransportError:
+                code = 0
+            latencies.append(time.perf_counter() - started)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    async def converse(client: httpx.AsyncClient, user_id: int):
+        # the messages of a user are sent in order, like Telegram does
+        for i in range(args.messages):
+            await post(client, user_id, args.text.format(i=i))
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(headers=headers, timeout=args.timeout) as client:
+        await asyncio.gather(
+            *(converse(client, FIRST_USER_ID + i) for i in range(args.users))
+        )
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"sent {len(latencies)} updates in {elapsed:.2f}s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} updates/s")
+    print(f"statuses: {statuses}")
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(
+            f"latency: p50={quantiles[49] * 1000:.1f}ms "
+            f"p95={quantiles[94] * 1000:.1f}ms p99={quantiles[98] * 1000:.1f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post fake updates to the webhook")
+    parser.add_argument("--url", default="http://localhost/telegram")
+    parser.add_argument("--secret", default=None)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--text", default="message {i}")
+    asyncio.run(send(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import Protocol
+from typing import Any, Protocol
 
 __all__ = ["Chat", "Bot", "Application", "Message"]
 
@@ -25,6 +25,25 @@ class Bot(Protocol):
     async def send_photo(self, *args, **kwargs):
         ...
 
+    async def send_batch(
+        self, messages: list[dict], *, priority: str = "bulk"
+    ) -> list[Any | Exception]:
+        """
+        Send many messages, e.g. notifications, the failures are returned in place
+        of the results. A message is either {"chat_id", "text", ...} or
+        {"chat_id", "photo", "caption", ...}, like the extended templates.
+        """
+        results = []
+        for message in messages:
+            send = self.send_photo if "photo" in message else self.send_message
+            chat_id, kwargs = message["chat_id"], message.copy()
+            del kwargs["chat_id"]
+            try:
+                results.append(await send(chat_id, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
 
 class Application(Protocol):
     bot: Bot
@@ -4,16 +4,14 @@ from uuid import UUID
 from pydantic import BaseModel, Field
 
 from app.models.content import Content
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Answer"]
 
-settings = get_settings()
-
 
 class Answer(BaseModel):
     id: UUID | None = None
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     owner: UUID
     question: UUID
     user_trait: UUID
@@ -47,6 +47,8 @@ class Cache(BaseModel):
     created_options: list[Content] = Field(default_factory=list)
     validate_answer: bool = False
     is_reply_keyboard_set: bool = False
+    # the markup of the question message, so that the same one is not sent again
+    markup_key: str | None = None
 
     # matching-related
     suggestion: Suggestion | None = None
@@ -9,6 +9,7 @@ __all__ = ["Callback"]
 class Callback(BaseModel):
     id: UUID = Field(default_factory=uuid4)
     state_id: UUID
+    question_id: UUID | None = None
     data: Any
     auto_answer: bool = True
     is_persistent: bool = False
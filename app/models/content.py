@@ -3,14 +3,12 @@ from enum import Enum, unique
 from typing import Any
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Content", "ContentType"]
 
-settings = get_settings()
-
 
 @unique
 class ContentType(str, Enum):
@@ -34,7 +32,7 @@ _float_type = float
 
 class Content(BaseModel):
     id: UUID | None = None
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     owner: UUID | None = None
     type: ContentType
     description: str | None = None
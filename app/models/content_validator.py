@@ -9,12 +9,10 @@ from telegram import Document, PhotoSize
 from app.exceptions import ValidationError
 from app.models.content import Content
 from app.models.content import ContentType as CT
-from app.utils import get_settings
+from app.utils import get_current_bot
 
 __all__ = ["ContentValidator"]
 
-settings = get_settings()
-
 
 @total_ordering
 class ContentValidator(BaseModel):
@@ -76,7 +74,7 @@ class ContentValidator(BaseModel):
                     "metadata": {
                         "file_unique_id": payload.file_unique_id,
                         "file_id": payload.file_id,
-                        "bot": settings.bot.username,
+                        "bot": get_current_bot().username,
                     },
                 }
             )
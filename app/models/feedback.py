@@ -3,16 +3,14 @@ from uuid import UUID, uuid4
 
 from pydantic import BaseModel, Field
 
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Feedback"]
 
-settings = get_settings()
-
 
 class Feedback(BaseModel):
     id: UUID = Field(default_factory=uuid4)
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     from_user: UUID
     to_user: UUID
     response: int
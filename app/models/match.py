@@ -3,16 +3,14 @@ from uuid import UUID
 
 from pydantic import BaseModel, Field
 
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Match"]
 
-settings = get_settings()
-
 
 class Match(BaseModel):
     id: UUID
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     users: list[UUID]
     date_created: datetime.datetime = Field(datetime.datetime.utcnow)
     date_delivered: datetime.datetime | None = None
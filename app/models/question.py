@@ -5,16 +5,14 @@ from pydantic import BaseModel, Field
 from app.models.content import ContentType
 from app.models.option import Option
 from app.models.trait import Trait
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Question"]
 
-settings = get_settings()
-
 
 class Question(BaseModel):
     id: UUID = Field(default_factory=uuid4)
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     name: str
     emoji: str = ""
     label: str
@@ -4,19 +4,18 @@ from uuid import UUID, uuid4
 
 from pydantic import BaseModel, Field, ConfigDict
 
-from app.utils import get_logger, get_settings
+from app.utils import get_logger, get_current_bot_id
 
 __all__ = ["State"]
 
 logger = get_logger(__file__)
-settings = get_settings()
 
 
 class State(BaseModel):
     model_config = ConfigDict(ignored_types=(cached_property,))
 
     id: UUID = Field(default_factory=uuid4)
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     user: UUID
     statechart: UUID
     data: dict = Field(default_factory=dict)
@@ -2,18 +2,16 @@ import datetime
 from typing import Any
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Suggestion"]
 
-settings = get_settings()
-
 
 class Suggestion(BaseModel):
     id: UUID
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     owner: UUID
     candidate: UUID
     score: float
@@ -4,16 +4,14 @@ from uuid import UUID
 from pydantic import BaseModel, Field
 
 from app.models.content import ContentType
-from app.utils import get_settings
+from app.utils import get_current_bot_id
 
 __all__ = ["Trait"]
 
-settings = get_settings()
-
 
 class Trait(BaseModel):
     id: UUID
-    bot: UUID = settings.bot_id
+    bot: UUID = Field(default_factory=get_current_bot_id)
     name: str
     emoji: str = ""
     is_visible: bool = True
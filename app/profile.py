@@ -1,4 +1,10 @@
-from functools import lru_cache
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import defaultdict
+from typing import Any, NamedTuple
 
 from sqlalchemy import (
     UUID,
@@ -10,22 +16,66 @@ from sqlalchemy import (
     MetaData,
     Table,
     Text,
-    create_engine,
+    any_,
+    bindparam,
+    event,
     func,
+    inspect,
+    insert,
+    make_url,
+    select,
+    text,
+    update,
 )
-from sqlalchemy.dialects.postgresql import JSONB, NUMRANGE, TSTZRANGE
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, NUMRANGE, TSTZRANGE
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 
-from app.models import ContentType
-from app.utils import get_settings
+from app.models import ContentType, Role, Trait, User
+from app.utils import (
+    get_bot_runtime,
+    get_current_bot,
+    get_logger,
+    get_repository,
+    get_settings,
+)
 
-__all__ = ["Session", "get_profile", "get_profile_class", "content_type_to_column"]
+__all__ = [
+    "Session",
+    "get_profile",
+    "get_profiles",
+    "get_profile_class",
+    "get_profile_table_name",
+    "invalidate_profile_class",
+    "content_type_to_column",
+    "ProfileSession",
+    "LazyProfile",
+    "references_profile",
+    "ProfileWriteBuffer",
+    "profile_buffer",
+    "ProfileTablePlan",
+    "plan_profile_schema",
+    "apply_profile_schema",
+    "is_profile_clean",
+    "get_profile_card",
+    "set_profile_card",
+]
 
+logger = get_logger(__file__)
 settings = get_settings()
+repo = get_repository()
 
-engine = create_engine(str(settings.postgres_url))
-Session = sessionmaker(engine)
+# psycopg3 provides both the sync and the async drivers
+engine = create_async_engine(
+    make_url(str(settings.postgres_url)).set(drivername="postgresql+psycopg"),
+    pool_size=settings.postgres_pool_size,
+    max_overflow=settings.postgres_max_overflow,
+    pool_timeout=settings.postgres_pool_timeout,
+)
+# the profiles are used after the commit, e.g. while rendering the templates
+Session = async_sessionmaker(engine, expire_on_commit=False)
 
 content_type_to_column = {
     ContentType.TEXT: Text,
@@ -44,21 +94,16 @@ content_type_to_column = {
 }
 
 
-def add_column(table_name, column):
-    column_name = column.compile(dialect=engine.dialect)
-    column_type = column.type.compile(engine.dialect)
-    engine.execute(
-        "ALTER TABLE %s ADD COLUMN %s %s" % (table_name, column_name, column_type)
-    )
+_profile_classes: dict[str, type] = {}
+_profile_classes_lock = asyncio.Lock()
 
 
-@lru_cache()
-def get_profile_class(role: str):
-    meta = MetaData()
-    table_name = f"{role}@{settings.bot.username}"
-    table = Table(
-        table_name,
-        meta,
+def get_profile_table_name(role: str) -> str:
+    return f"{role}@{get_current_bot().username}"
+
+
+def _get_base_columns() -> list[Column]:
+    return [
         Column(
             "id",
             UUID,
@@ -78,17 +123,463 @@ def get_profile_class(role: str):
             server_default=func.now(),
             onupdate=func.now(),
         ),
+    ]
+
+
+def _reflect_profile_table(connection, table_name: str) -> MetaData:
+    meta = MetaData()
+    table = Table(table_name, meta, *_get_base_columns())
+    meta.create_all(connection, tables=[table])
+    # only the profile table is reflected, the base columns keep their definitions
+    meta = MetaData()
+    Table(table_name, meta, *_get_base_columns(), autoload_with=connection)
+    return meta
+
+
+def _map_profile_class(meta: MetaData, table_name: str):
+    base = automap_base(metadata=meta)
+    # server-side defaults are fetched eagerly, lazy loading is not possible with async
+    class_ = type(
+        table_name,
+        (base,),
+        {"__tablename__": table_name, "__mapper_args__": {"eager_defaults": True}},
     )
-    meta.create_all(engine, tables=[table])
-    base = automap_base()
-    base.prepare(autoload_with=engine)
-    return getattr(base.classes, table_name)
+    base.prepare()
+    return class_
+
+
+def _make_schema_key(table_name: str) -> str:
+    return f"profile:table[{table_name}]"
+
+
+async def get_profile_class(role: str):
+    table_name = get_profile_table_name(role)
+    if (class_ := _profile_classes.get(table_name)) is not None:
+        return class_
+    async with _profile_classes_lock:
+        if (class_ := _profile_classes.get(table_name)) is None:
+            # the reflected schema is shared between the workers and the restarts
+            key = _make_schema_key(table_name)
+            if (meta := await repo.get_pickle(key)) is None:
+                async with engine.begin() as connection:
+                    meta = await connection.run_sync(_reflect_profile_table, table_name)
+                await repo.set_pickle(key, meta, ex=settings.cache_ex_profile_schema)
+            class_ = _profile_classes[table_name] = _map_profile_class(meta, table_name)
+    return class_
+
+
+async def invalidate_profile_class(role: str):
+    """Drop the cached schema, e.g. after the table has been altered"""
+    table_name = get_profile_table_name(role)
+    await repo.remove_pickle(_make_schema_key(table_name))
+    _profile_classes.pop(table_name, None)
+    await repo.publish_invalidation("profile", table_name)
 
 
-def get_profile(session: Session, role: str, user_id: UUID):
-    class_ = get_profile_class(role)
-    profile = session.query(class_).get(user_id)
+async def _on_profile_invalidated(table_name: str | None):
+    if table_name is None:
+        _profile_classes.clear()
+    else:
+        _profile_classes.pop(table_name, None)
+
+
+repo.on_invalidate("profile", _on_profile_invalidated)
+
+
+async def get_profile(session: AsyncSession, role: str, user_id: UUID):
+    class_ = await get_profile_class(role)
+    profile = await session.get(class_, user_id)
     if profile is None:
         profile = class_(id=user_id)
         session.add(profile)
+    profile_buffer.apply(profile)
     return profile
+
+
+async def get_profiles(session: AsyncSession, role: str, user_ids: list[UUID]) -> dict:
+    class_ = await get_profile_class(role)
+    user_ids = list(set(user_ids))
+    ids = bindparam("ids", user_ids, type_=ARRAY(UUID))
+    result = await session.scalars(select(class_).where(class_.id == any_(ids)))
+    profiles = {profile.id: profile for profile in result}
+    for profile in profiles.values():
+        profile_buffer.apply(profile)
+    for user_id in user_ids:
+        if user_id not in profiles:
+            profiles[user_id] = profile = class_(id=user_id)
+            session.add(profile)
+    return profiles
+
+
+class ProfileTablePlan(NamedTuple):
+    role: Role
+    table_name: str
+    missing_traits: list[Trait]
+    estimated_rows: int | None
+
+
+async def plan_profile_schema(roles: list[Role]) -> list[ProfileTablePlan]:
+    """Compare the role traits with the reflected tables"""
+    tables = {}
+    for role in roles:
+        tables[role.label] = (await get_profile_class(role.label)).__table__
+    # the planner statistics are used instead of counting the rows
+    estimates_query = text(
+        "SELECT reltuples::bigint, pg_relation_size(oid) FROM pg_class"
+        " WHERE oid = to_regclass(:name)"
+    )
+    plans = []
+    async with engine.connect() as connection:
+        quote = connection.dialect.identifier_preparer.quote
+        for role in roles:
+            table = tables[role.label]
+            estimate = None
+            result = await connection.execute(
+                estimates_query, {"name": quote(table.name)}
+            )
+            if row := result.first():
+                estimate, size = row
+                # reltuples is -1 for the tables never analyzed, e.g. the new ones,
+                # but those without any data on the disk are empty for sure
+                if estimate < 0 and size == 0:
+                    estimate = 0
+            missing_traits = [
+                trait for trait in role.traits if trait.column not in table.columns
+            ]
+            plans.append(
+                ProfileTablePlan(
+                    role=role,
+                    table_name=table.name,
+                    missing_traits=missing_traits,
+                    estimated_rows=(
+                        estimate if estimate is not None and estimate >= 0 else None
+                    ),
+                )
+            )
+    return plans
+
+
+async def apply_profile_schema(plans: list[ProfileTablePlan]) -> dict[str, str]:
+    """Add the missing columns with one ALTER per table, returns the errors"""
+    errors = {}
+    for plan in plans:
+        if not plan.missing_traits:
+            continue
+        async with engine.connect() as connection:
+            quote = connection.dialect.identifier_preparer.quote
+            clauses = ", ".join(
+                "ADD COLUMN IF NOT EXISTS %s %s"
+                % (
+                    quote(trait.column),
+                    content_type_to_column[trait.type]().compile(connection.dialect),
+                )
+                for trait in plan.missing_traits
+            )
+            try:
+                async with connection.begin():
+                    # do not queue behind the long transactions, fail instead
+                    await connection.execute(
+                        text(
+                            "SET LOCAL lock_timeout = %d"
+                            % settings.profile_ddl_lock_timeout
+                        )
+                    )
+                    await connection.execute(
+                        text(f"ALTER TABLE {quote(plan.table_name)} {clauses}")
+                    )
+            except DBAPIError as e:
+                logger.error(f"could not alter {plan.table_name!r}: {e}")
+                errors[plan.table_name] = str(e.orig)
+                continue
+        logger.info(f"altered {plan.table_name!r}: {clauses}")
+        await invalidate_profile_class(plan.role.label)
+    return errors
+
+
+_profile_reference = re.compile(r"\bprofile\b")
+
+
+def references_profile(code: str | None) -> bool:
+    """Check whether the code or the template might access the user's profile"""
+    return bool(code) and _profile_reference.search(code) is not None
+
+
+class ProfileSession:
+    """
+    Opens the database session on the first use and commits it only if something
+    has been written, so the dispatches which do not touch the profiles are free.
+    """
+
+    def __init__(self):
+        self._session: AsyncSession | None = None
+        # the bot's share of the connection pool, held while the session is open
+        self._db_semaphore: asyncio.Semaphore | None = None
+        self._is_flushed = False
+        # the profiles loaded during the dispatch, by the user id
+        self._profiles: dict[Any, Any] = {}
+
+    async def get_session(self) -> AsyncSession:
+        if self._session is None:
+            if self._db_semaphore is None:
+                self._db_semaphore = get_bot_runtime().db_semaphore
+                await self._db_semaphore.acquire()
+            self._session = Session()
+            event.listen(self._session.sync_session, "after_flush", self._on_flush)
+        return self._session
+
+    def _on_flush(self, *_):
+        self._is_flushed = True
+
+    @property
+    def is_modified(self) -> bool:
+        if self._session is None:
+            return False
+        session = self._session
+        return self._is_flushed or bool(session.new or session.dirty or session.deleted)
+
+    async def get(self, role: str, user_id: UUID):
+        if (profile := self._profiles.get(user_id)) is None:
+            profile = await get_profile(await self.get_session(), role, user_id)
+            self._profiles[user_id] = profile
+        return profile
+
+    async def get_many(self, user_ids_by_role: dict[str, list[UUID]]) -> dict:
+        """Load the profiles with one query per role table"""
+        for role, user_ids in user_ids_by_role.items():
+            if missing := [uid for uid in user_ids if uid not in self._profiles]:
+                session = await self.get_session()
+                self._profiles.update(await get_profiles(session, role, missing))
+        return {
+            user_id: self._profiles[user_id]
+            for user_ids in user_ids_by_role.values()
+            for user_id in user_ids
+        }
+
+    async def close(self, *, commit: bool = True):
+        if self._session is None:
+            return
+        try:
+            if commit and self.is_modified:
+                await self._session.commit()
+            else:
+                await self._session.rollback()
+        finally:
+            try:
+                await self._session.close()
+            finally:
+                self._session = None
+                self._is_flushed = False
+                self._profiles.clear()
+                self._db_semaphore.release()
+                self._db_semaphore = None
+
+    async def __aenter__(self) -> "ProfileSession":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close(commit=exc_type is None)
+
+
+class LazyProfile:
+    """A profile which is loaded only when it is needed"""
+
+    def __init__(self, session: ProfileSession, role: str, user_id: UUID):
+        vars(self).update(_session=session, _role=role, _user_id=user_id, _row=None)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._row is not None
+
+    async def load(self) -> Any:
+        if self._row is None:
+            self._row = await self._session.get(self._role, self._user_id)
+        return self._row
+
+    def _get_row(self) -> Any:
+        if self._row is None:
+            raise RuntimeError("The profile is not loaded, await profile.load() first")
+        return self._row
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._get_row(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        if name == "_row":
+            vars(self)["_row"] = value
+        else:
+            setattr(self._get_row(), name, value)
+
+
+class ProfileWriteBuffer:
+    """
+    Collects the written profile columns and flushes them in bulk: the rows are
+    inserted into a staging table and the profile table is updated from it.
+    """
+
+    max_attempts = 3
+
+    def __init__(self):
+        # table name -> user id -> column -> value
+        self._pending: dict[str, dict[Any, dict[str, Any]]] = defaultdict(dict)
+        self._attempts: dict[tuple[str, Any], int] = defaultdict(int)
+        self._first_failures: dict[tuple[str, Any], float] = {}
+        self._tables: dict[str, Table] = {}
+        self._is_full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._worker: asyncio.Task | None = None
+        self._is_closing = False
+
+    @property
+    def size(self) -> int:
+        return sum(len(rows) for rows in self._pending.values())
+
+    def write(self, profile: Any, column: str, value: Any):
+        if not inspect(profile).persistent:
+            # the row is inserted by the session's commit, there is nothing to update
+            setattr(profile, column, value)
+            return
+        table = type(profile).__table__
+        self._tables[table.name] = table
+        self._pending[table.name].setdefault(profile.id, {})[column] = value
+        # the value is visible right away, but the session does not write it
+        set_committed_value(profile, column, value)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        if self.size >= settings.profile_flush_size:
+            self._is_full.set()
+
+    def has_pending(self, profile: Any) -> bool:
+        return profile.id in self._pending.get(type(profile).__table__.name, {})
+
+    def apply(self, profile: Any):
+        """Overlay the pending values on a profile that has just been loaded"""
+        rows = self._pending.get(type(profile).__table__.name, {})
+        for column, value in rows.get(profile.id, {}).items():
+            set_committed_value(profile, column, value)
+
+    async def _run(self):
+        while not self._is_closing:
+            try:
+                await asyncio.wait_for(
+                    self._is_full.wait(), timeout=settings.profile_flush_interval
+                )
+            except TimeoutError:
+                pass
+            self._is_full.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            pending, self._pending = self._pending, defaultdict(dict)
+            for table_name, rows in pending.items():
+                try:
+                    updated = await self._flush_table(self._tables[table_name], rows)
+                except Exception as e:
+                    logger.error(f"could not flush the profiles of {table_name}: {e}")
+                    updated = set()
+                self._requeue(table_name, rows, updated)
+
+    def _requeue(self, table_name: str, rows: dict[Any, dict], updated: set):
+        for user_id, columns in rows.items():
+            key = (table_name, user_id)
+            if user_id in updated:
+                self._attempts.pop(key, None)
+                self._first_failures.pop(key, None)
+                continue
+            # the row might not be committed yet, or the flush has failed, the full
+            # buffer flushes back to back, so the dispatch is given some time too
+            self._attempts[key] += 1
+            failed_at = self._first_failures.setdefault(key, time.monotonic())
+            grace = settings.profile_flush_interval * self.max_attempts
+            if (
+                self._attempts[key] >= self.max_attempts
+                and time.monotonic() - failed_at >= grace
+            ):
+                logger.error(f"dropped the profile changes of {user_id}: {columns}")
+                self._attempts.pop(key)
+                self._first_failures.pop(key)
+                continue
+            newer = self._pending[table_name].setdefault(user_id, {})
+            self._pending[table_name][user_id] = columns | newer
+
+    async def _flush_table(self, table: Table, rows: dict[Any, dict]) -> set:
+        # rows with the same columns share a staging table
+        groups: dict[tuple[str, ...], list[dict]] = defaultdict(list)
+        for user_id, columns in rows.items():
+            groups[tuple(sorted(columns))].append({"id": user_id, **columns})
+        updated = set()
+        async with engine.begin() as connection:
+            for i, (columns, values) in enumerate(groups.items()):
+                staging = Table(
+                    f"{table.name}:staging:{i}",
+                    MetaData(),
+                    *(Column(name, table.c[name].type) for name in ("id", *columns)),
+                    prefixes=["TEMPORARY"],
+                    postgresql_on_commit="DROP",
+                )
+                await connection.run_sync(staging.create)
+                await connection.execute(insert(staging), values)
+                statement = (
+                    update(table)
+                    .where(table.c.id == staging.c.id)
+                    .values(
+                        {name: staging.c[name] for name in columns}
+                        | {"date_modified": func.now()}
+                    )
+                    .returning(table.c.id)
+                )
+                updated.update(await connection.scalars(statement))
+        return updated
+
+    async def close(self):
+        """Flush the pending changes, e.g. on shutdown"""
+        if self._worker is not None:
+            # cancelling the worker in the middle of a flush would lose the batch
+            self._is_closing = True
+            self._is_full.set()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+            self._is_closing = False
+        await self.flush()
+        if size := self.size:
+            logger.error(f"could not flush {size} profiles on shutdown")
+
+
+profile_buffer = ProfileWriteBuffer()
+
+
+def is_profile_clean(profile: Any) -> bool:
+    """Whether the row matches the database, so its date_modified is up to date"""
+    return not inspect(profile).modified and not profile_buffer.has_pending(profile)
+
+
+def _make_card_key(user: User, profile: Any, template: str) -> str | None:
+    if (date_modified := getattr(profile, "date_modified", None)) is None:
+        return None
+    # the template can show the user's fields as well
+    digest = hashlib.sha1(template.encode())
+    digest.update(user.model_dump_json().encode())
+    return f"profile:card[{user.id}]:{digest.hexdigest()}:{date_modified.timestamp()}"
+
+
+async def get_profile_card(
+    user: User, profile: Any, template: str
+) -> tuple[str, list[str]] | None:
+    """
+    The rendered profile card, the key changes with the row's date_modified,
+    so the outdated cards are never read and just expire.
+    """
+    if (key := _make_card_key(user, profile, template)) is None:
+        return None
+    if data := await repo.db.get(key):
+        card = json.loads(data)
+        return card["text"], card["photos"]
+
+
+async def set_profile_card(
+    user: User, profile: Any, template: str, text_: str, photos: list[str]
+):
+    if (key := _make_card_key(user, profile, template)) is None:
+        return
+    data = json.dumps({"text": text_, "photos": photos})
+    await repo.db.set(key, data, ex=settings.cache_ex_profile_card)
@@ -1,23 +1,32 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from typing import Any
 
 from telegram import (
+    CallbackQuery,
     InlineKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
+from telegram.error import BadRequest
 
 __all__ = ["QuestionManager"]
 
-from app.engine.logic import make_inline_button
-from app.models import Cache, Option
+from app.engine.logic import create_inline_button
+from app.models import Cache, Callback, Option
 from app.repository import Repository
 from app.utils import get_logger, get_settings
 
 logger = get_logger(__name__)
 settings = get_settings()
 
+# the name and the callback data of every button
+ButtonRows = list[list[tuple[str, str]]]
+
+# the markups are shared by the users, only the inline callbacks are their own
+_markups: OrderedDict[tuple, ButtonRows | ReplyKeyboardMarkup | ReplyKeyboardRemove]
+_markups = OrderedDict()
+
 
 class QuestionManager:
     action_skip_question = "skip question"
@@ -33,8 +42,20 @@ class QuestionManager:
             self.question.options
         )
         self.is_inline = self.question.allow_multiple_choices
+        self._callbacks: list[Callback] = []
         for option in self.options:
             option.is_active = option.id in state.selected_options.keys()
+        # the cached markups are tied to this version of the question
+        self._fingerprint = hash(
+            (
+                self.question.id,
+                self.question.text_skip,
+                self.question.allow_multiple_choices,
+                self.question.allow_skipping,
+                self.question.allow_empty_answers,
+                *((o.id, o.name, o.emoji, o.row, o.column) for o in self.options),
+            )
+        )
 
     @staticmethod
     def _generate_option_layout(options: list[Option]) -> list[list[Option]]:
@@ -48,13 +69,18 @@ class QuestionManager:
 
     async def create_button(self, name: str, data: Any, **kwargs):
         if self.is_inline:
-            return await make_inline_button(
-                self.state, self.repo, name, data=data, **kwargs
+            # the callbacks are saved at once when the markup is created
+            button, callback = create_inline_button(
+                self.state, name, data=data, question_id=self.question.id, **kwargs
             )
+            self._callbacks.append(callback)
+            return button
         return KeyboardButton(name, **kwargs)
 
-    def _create_markup(self, buttons: list[list]):
+    async def _create_markup(self, buttons: list[list]):
         if self.is_inline:
+            await self.repo.callbacks.save_many(self._callbacks)
+            self._callbacks.clear()
             return InlineKeyboardMarkup(buttons)
         if buttons:
             return ReplyKeyboardMarkup(buttons, resize_keyboard=True)
@@ -69,28 +95,84 @@ class QuestionManager:
             return "Отправить"
         return "Ничего из перечисленного"
 
-    async def _create_choice_buttons(self) -> list[list]:
+    def _describe_choice_buttons(self) -> ButtonRows:
         return [
-            [
-                await self.create_button(str(option), data=str(option.id))
-                for option in row
-            ]
+            [(str(option), str(option.id)) for option in row]
             for row in self.option_layout
         ]
 
     def get_options(self) -> list[str]:
         return [str(option.id if self.is_inline else option) for option in self.options]
 
+    def _make_markup_key(self, is_final: bool, is_skipped: bool) -> tuple:
+        selection = sum(
+            1 << i
+            for i, o in enumerate(self.options)
+            if o.id in self.state.selected_options
+        )
+        has_choices = self.state.total_choices > 0
+        return self._fingerprint, selection, has_choices, is_final, is_skipped
+
+    def _make_sent_markup_key(self, is_final: bool, is_skipped: bool) -> str:
+        # persisted with the cache, so it must not depend on the process
+        _, *flags = self._make_markup_key(is_final, is_skipped)
+        return ":".join(map(str, (self.question.id, *flags)))
+
     async def get_markup(
         self, is_final: bool = False, is_skipped: bool = False
-    ) -> InlineKeyboardMarkup:
-        buttons = await self._create_choice_buttons()
+    ) -> InlineKeyboardMarkup | ReplyKeyboardMarkup | ReplyKeyboardRemove:
+        key = self._make_markup_key(is_final, is_skipped)
+        # the markup is not known to be sent until mark_markup_sent is called
+        self.state.markup_key = None
+        if (cached := _markups.get(key)) is None:
+            cached = self._describe_buttons(is_final, is_skipped)
+            if not self.is_inline:
+                cached = await self._create_markup(await self._create_buttons(cached))
+            _markups[key] = cached
+            if len(_markups) > settings.markup_cache_size:
+                _markups.popitem(last=False)
+        else:
+            _markups.move_to_end(key)
+        if not self.is_inline:
+            return cached
+        # the callbacks belong to the user, so they are created every time
+        return await self._create_markup(await self._create_buttons(cached))
+
+    def mark_markup_sent(self, is_final: bool = False, is_skipped: bool = False):
+        """Remember the markup of the question message once it has been sent"""
+        self.state.markup_key = self._make_sent_markup_key(is_final, is_skipped)
+
+    async def edit_markup(
+        self, query: CallbackQuery, is_final: bool = False, is_skipped: bool = False
+    ) -> bool:
+        """Update the markup of the question message, unless it is the same already"""
+        key = self._make_sent_markup_key(is_final, is_skipped)
+        if self.state.markup_key == key:
+            return False
+        markup = await self.get_markup(is_final=is_final, is_skipped=is_skipped)
+        try:
+            await query.edit_message_reply_markup(markup)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+            self.mark_markup_sent(is_final, is_skipped)
+            return False
+        self.mark_markup_sent(is_final, is_skipped)
+        return True
+
+    async def _create_buttons(self, rows: ButtonRows) -> list[list]:
+        return [
+            [await self.create_button(name, data=data) for name, data in row]
+            for row in rows
+        ]
+
+    def _describe_buttons(self, is_final: bool, is_skipped: bool) -> ButtonRows:
+        rows = self._describe_choice_buttons()
 
         # button "save" for questions with multiple choices
         if self.question.allow_multiple_choices and self.is_answer_valid:
             action = self.get_action(is_final, is_skipped)
-            button = await self.create_button(action, data=self.action_save_answer)
-            buttons.append([button])
+            rows.append([(action, self.action_save_answer)])
 
         # button "skip"
         if (
@@ -98,13 +180,9 @@ class QuestionManager:
             and self.state.total_choices == 0
             and not is_final
         ):
-            skip_button = await self.create_button(
-                self.question.text_skip,
-                data=self.action_skip_question,
-            )
-            buttons.append([skip_button])
+            rows.append([(self.question.text_skip, self.action_skip_question)])
 
-        return self._create_markup(buttons)
+        return rows
 
     def parse_option(self, item: str) -> Option:
         for option in self.options:
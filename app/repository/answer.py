@@ -1,9 +1,15 @@
+import asyncio
+
+import httpx
+from pydantic import TypeAdapter
+
 from app.models import Answer
 from app.repository.model import BaseRwModelRepository
-from app.utils import get_settings
+from app.utils import get_logger, get_settings, split
 
 __all__ = ["AnswerRepository"]
 
+logger = get_logger(__file__)
 settings = get_settings()
 
 
@@ -13,11 +19,128 @@ class AnswerRepository(BaseRwModelRepository[Answer]):
     ex = settings.cache_ex_answers
     url = "/answers"
 
+    def __init__(self, core):
+        super().__init__(core)
+        self._queue: asyncio.Queue[Answer] = asyncio.Queue(
+            maxsize=settings.answers_queue_size
+        )
+        self._worker: asyncio.Task | None = None
+
     async def create(self, answer: Answer, **_) -> Answer:
         data = answer.model_dump_json(exclude_none=True)
         headers = {"Content-Type": "application/json"}
         response = await self.core.httpx.post(
-            f"/answers/", headers=headers, content=data
+            f"{self.url}/", headers=headers, content=data
         )
         response.raise_for_status()
         return Answer.model_validate(response.json())
+
+    async def create_many(self, answers: list[Answer]) -> list[Answer]:
+        data = TypeAdapter(list[Answer]).dump_json(answers, exclude_none=True)
+        headers = {"Content-Type": "application/json"}
+        response = await self.core.httpx.post(
+            f"{self.url}/", headers=headers, content=data
+        )
+        if response.status_code in (400, 404, 405):
+            # the backend does not support the bulk creates or rejects the list
+            logger.warning("bulk create is not supported, creating one by one")
+            return await self._create_one_by_one(answers)
+        response.raise_for_status()
+        return TypeAdapter(list[Answer]).validate_python(response.json())
+
+    async def _create_one_by_one(self, answers: list[Answer]) -> list[Answer]:
+        created, failed = [], []
+        for chunk in split(answers, 10):
+            results = await asyncio.gather(
+                *(self.create(answer) for answer in chunk), return_exceptions=True
+            )
+            for answer, result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    logger.error(f"could not create the answer: {result}")
+                    failed.append(answer)
+                else:
+                    created.append(result)
+        if failed:
+            # retrying the whole batch would duplicate the created answers
+            await self._store_failed(failed)
+        return created
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def enqueue(self, answer: Answer) -> None:
+        """Schedule the answer for a bulk creation, waits if the queue is full"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        await self._queue.put(answer)
+
+    async def _next_batch(self) -> list[Answer]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + settings.answers_batch_interval
+        while len(batch) < settings.answers_batch_size:
+            try:
+                answer = await asyncio.wait_for(
+                    self._queue.get(), timeout=max(deadline - loop.time(), 0)
+                )
+            except TimeoutError:
+                break
+            batch.append(answer)
+        return batch
+
+    async def _send(self, batch: list[Answer]) -> None:
+        for attempt in range(settings.answers_max_retries):
+            try:
+                await self.create_many(batch)
+            except httpx.HTTPStatusError as e:
+                # there is no point in retrying a request the backend has rejected
+                if e.response.is_client_error and e.response.status_code != 429:
+                    break
+                error = e
+            except httpx.TransportError as e:
+                error = e
+            else:
+                logger.debug(f"sent {len(batch)} answers, {self.queue_depth} queued")
+                return
+            if attempt + 1 == settings.answers_max_retries:
+                logger.warning(f"could not send answers ({error})")
+                break
+            delay = min(settings.answers_retry_delay * 2**attempt, 60)
+            logger.warning(f"could not send answers ({error}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+        await self._store_failed(batch)
+
+    async def _store_failed(self, batch: list[Answer]) -> None:
+        # keep the answers, so that they can be recovered manually
+        logger.error(f"could not send {len(batch)} answers, moving them to redis")
+        await self.core.db.rpush(
+            f"{self.key}:failed",
+            *(answer.model_dump_json(exclude_none=True) for answer in batch),
+        )
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._send(batch)
+            except Exception as e:
+                logger.error(f"lost {len(batch)} answers: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def close(self) -> None:
+        """Wait until the queued answers are sent"""
+        if self._worker is None:
+            return
+        if self.queue_depth:
+            logger.info(f"draining {self.queue_depth} answers")
+        try:
+            await asyncio.wait_for(
+                self._queue.join(), timeout=settings.answers_drain_timeout
+            )
+        except TimeoutError:
+            logger.error(f"could not drain the answers, {self.queue_depth} are lost")
+        self._worker.cancel()
+        self._worker = None
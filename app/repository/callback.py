@@ -1,14 +1,135 @@
+import pickle
+from uuid import UUID
+
 from app.models import Callback
-from app.repository.model import BaseModelRepository
+from app.repository.model import ID, BaseModelRepository
+from app.utils import get_settings
 
 __all__ = ["CallbackRepository"]
 
-from app.utils import get_settings
-
 settings = get_settings()
 
 
-class CallbackRepository(BaseModelRepository):
+class CallbackRepository(BaseModelRepository[Callback]):
+    """
+    Callbacks are kept in one hash per state: the persistent ones, the ones bound
+    to a question (dropped once the question is answered) and the rest.
+    """
+
     model = Callback
-    ex = None
+    ex = settings.cache_ex_callback
     key = "callback"
+
+    def _make_hash_key(
+        self, state_id: UUID, *, question_id: UUID | None = None, persistent=False
+    ) -> str:
+        key = f"{self.key}:state[{state_id}]"
+        if persistent:
+            return f"{key}:persistent"
+        if question_id is not None:
+            return f"{key}:question[{question_id}]"
+        return key
+
+    def _make_questions_key(self, state_id: UUID) -> str:
+        # the questions with callbacks, so that their hashes are found without SCAN
+        return f"{self.key}:state[{state_id}]:questions"
+
+    async def _get_hash_keys(self, state_id: UUID) -> list[str]:
+        question_ids = await self.core.db.smembers(self._make_questions_key(state_id))
+        return [
+            self._make_hash_key(state_id),
+            self._make_hash_key(state_id, persistent=True),
+            *(
+                self._make_hash_key(state_id, question_id=question_id)
+                for question_id in question_ids
+            ),
+        ]
+
+    async def save_many(self, callbacks: list[Callback]) -> None:
+        if not callbacks:
+            return
+        hashes: dict[str, dict[str, bytes]] = {}
+        questions: dict[str, set[str]] = {}
+        for callback in callbacks:
+            if callback.question_id is not None and not callback.is_persistent:
+                questions.setdefault(
+                    self._make_questions_key(callback.state_id), set()
+                ).add(str(callback.question_id))
+            key = self._make_hash_key(
+                callback.state_id,
+                question_id=callback.question_id,
+                persistent=callback.is_persistent,
+            )
+            hashes.setdefault(key, {})[str(callback.id)] = pickle.dumps(callback)
+        async with self.core.raw_db.pipeline(transaction=False) as pipe:
+            for key, mapping in hashes.items():
+                pipe.hset(key, mapping=mapping)
+                if not key.endswith(":persistent"):
+                    pipe.expire(key, self.ex)
+            for key, question_ids in questions.items():
+                pipe.sadd(key, *question_ids)
+                pipe.expire(key, self.ex)
+            await pipe.execute()
+
+    async def save(self, obj: Callback, id_: ID = None, **kwargs) -> None:
+        await self.save_many([obj])
+
+    async def load(
+        self,
+        id_: ID | None,
+        *,
+        state_id: UUID = None,
+        question_id: UUID | None = None,
+        **kwargs,
+    ) -> Callback | None:
+        if id_ is None or state_id is None:
+            return None
+        field = self._extract_id(id_)
+        keys = [
+            self._make_hash_key(state_id),
+            self._make_hash_key(state_id, persistent=True),
+        ]
+        if question_id is not None:
+            keys.append(self._make_hash_key(state_id, question_id=question_id))
+        async with self.core.raw_db.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hget(key, field)
+            results = await pipe.execute()
+        for data in results:
+            if data is not None:
+                return pickle.loads(data)
+        return await self._load_legacy(field, state_id)
+
+    async def _load_legacy(self, field: str, state_id: UUID) -> Callback | None:
+        # the keyboards sent before the hashes have their callbacks in own keys
+        callback = await super().load(field)
+        if callback is None or callback.state_id != state_id:
+            return None
+        await self.save_many([callback])
+        await super().remove(field)
+        return callback
+
+    async def remove(self, id_: ID | None, *, state_id: UUID = None, **kwargs) -> None:
+        if isinstance(id_, Callback):
+            state_id = id_.state_id
+        if state_id is None:
+            return
+        field = self._extract_id(id_)
+        keys = await self._get_hash_keys(state_id)
+        async with self.core.raw_db.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hdel(key, field)
+            await pipe.execute()
+        await super().remove(field)
+
+    async def clear(self, state_id: UUID, *, question_id: UUID | None = None) -> None:
+        """Drop the non-persistent callbacks, e.g. when the question is answered"""
+        async with self.core.raw_db.pipeline(transaction=False) as pipe:
+            pipe.delete(self._make_hash_key(state_id, question_id=question_id))
+            if question_id is not None:
+                pipe.srem(self._make_questions_key(state_id), str(question_id))
+            await pipe.execute()
+
+    async def clear_state(self, state_id: UUID) -> None:
+        keys = await self._get_hash_keys(state_id)
+        await self.core.raw_db.delete(*keys, self._make_questions_key(state_id))
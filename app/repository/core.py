@@ -1,14 +1,18 @@
+import asyncio
+import json
 import pickle
-from typing import Any
+import time
+from collections import defaultdict
+from functools import cached_property
+from typing import Any, Callable, Coroutine
 
-import httpx
 import redis.asyncio
-from authlib.integrations.httpx_client import AsyncOAuth2Client
-from httpx import AsyncClient, Response
+from authlib.integrations.httpx_client import AsyncOAuth2Client, OAuthError
+from httpx import USE_CLIENT_DEFAULT, HTTPStatusError, Response
 
-from app.utils import get_logger, get_settings
+from app.utils import get_bot_runtime, get_logger, get_settings
 
-__all__ = ["Repository"]
+__all__ = ["Repository", "BackendClient"]
 
 settings = get_settings()
 logger = get_logger(__file__)
@@ -23,13 +27,90 @@ def init_redis_client(decode_responses=True) -> redis.asyncio.Redis:
     )
 
 
+class BackendClient(AsyncOAuth2Client):
+    """
+    Obtains the token on demand and shares it between the workers through redis.
+    Login and refresh are single-flight both within and across the processes.
+    """
+
+    token_key = "backend:token"
+
+    def __init__(self, db: redis.asyncio.Redis, **kwargs):
+        super().__init__(
+            token_endpoint="/token/refresh/", update_token=self._store_token, **kwargs
+        )
+        self._db = db
+
+    async def request(
+        self, method, url, withhold_token=False, auth=USE_CLIENT_DEFAULT, **kwargs
+    ):
+        if not withhold_token and auth is USE_CLIENT_DEFAULT and not self.token:
+            await self.ensure_active_token(None)
+        return await super().request(
+            method, url, withhold_token=withhold_token, auth=auth, **kwargs
+        )
+
+    def _is_token_active(self) -> bool:
+        return bool(self.token) and not self.token.is_expired()
+
+    async def ensure_active_token(self, token=None):
+        if self._is_token_active():
+            return
+        async with self._token_refresh_lock:
+            if self._is_token_active() or await self._load_token():
+                return
+            lock = self._db.lock(
+                f"{self.token_key}:lock", timeout=30, blocking_timeout=30
+            )
+            async with lock:
+                # another worker might have obtained the token in the meantime
+                if await self._load_token():
+                    return
+                await self._obtain_token()
+
+    async def _load_token(self) -> bool:
+        if data := await self._db.get(self.token_key):
+            self.token = json.loads(data)
+            return self._is_token_active()
+        return False
+
+    async def _store_token(self, token: dict, **_):
+        ex = settings.cache_ex_token
+        if expires_at := token.get("expires_at"):
+            ex = int(expires_at - time.time())
+        if ex > 0:
+            await self._db.set(self.token_key, json.dumps(dict(token)), ex=ex)
+
+    async def _obtain_token(self):
+        if self.token and (refresh_token := self.token.get("refresh_token")):
+            try:
+                await self.refresh_token(
+                    self.metadata["token_endpoint"], refresh_token=refresh_token
+                )
+            except (OAuthError, HTTPStatusError) as e:
+                logger.warning(f"could not refresh the backend token: {e}")
+            else:
+                return
+        logger.debug("obtaining a new backend token")
+        response = await self.post(
+            "/token/",
+            json={
+                "username": settings.backend_api_username.get_secret_value(),
+                "password": settings.backend_api_password.get_secret_value(),
+            },
+            withhold_token=True,
+        )
+        response.raise_for_status()
+        self.token = response.json()
+        await self._store_token(self.token)
+
+
 class Repository:
     def __init__(self):
         import app.repository as repos
 
         self.db = init_redis_client()
         self.raw_db = init_redis_client(decode_responses=False)
-        self.httpx = self._get_httpx_client()
 
         self.callbacks = repos.CallbackRepository(self)
         self.states = repos.StateRepository(self)
@@ -47,18 +128,16 @@ class Repository:
         self.feedbacks = repos.FeedbackRepository(self)
         self.matches = repos.MatchRepository(self)
 
-    def _get_httpx_client(self) -> AsyncClient:
-        token = httpx.post(
-            f"{settings.backend_api_url}/token/",
-            json={
-                "username": settings.backend_api_username.get_secret_value(),
-                "password": settings.backend_api_password.get_secret_value(),
-            },
-            verify=settings.backend_api_verify,
-        ).json()
-        return AsyncOAuth2Client(
-            token_endpoint="/token/refresh/",
-            token=token,
+        self._invalidation_callbacks: dict[
+            str, list[Callable[[str | None], Coroutine]]
+        ] = defaultdict(list)
+        self._invalidation_listener: asyncio.Task | None = None
+
+    @cached_property
+    def httpx(self) -> BackendClient:
+        # created on the first use, the token is obtained by the first request
+        return BackendClient(
+            self.db,
             # non-auth params
             http2=True,
             base_url=str(settings.backend_api_url),
@@ -86,9 +165,122 @@ class Repository:
         # noinspection PyUnresolvedReferences
         await self.raw_db.delete(key)
 
+    @staticmethod
+    def _make_bot_key(key: str) -> str:
+        # the telegram ids are unique only within a bot
+        return get_bot_runtime().make_key(key)
+
     async def mark_user_as_active(self, telegram_id: int):
         # noinspection PyUnresolvedReferences
-        await self.db.sadd("users", telegram_id)
+        await self.db.sadd(self._make_bot_key("users"), telegram_id)
 
     async def get_active_user_ids(self) -> set[int]:
-        return set(int(uid) for uid in await self.db.smembers("users"))
+        return set(
+            int(uid) for uid in await self.db.smembers(self._make_bot_key("users"))
+        )
+
+    async def schedule_user_wakeup(self, telegram_id: int, at: float | None):
+        """Remember when the user's statechart has to be woken up next"""
+        if at is None:
+            await self.db.zrem(self._make_bot_key("users:wakeup"), telegram_id)
+        else:
+            await self.db.zadd(self._make_bot_key("users:wakeup"), {telegram_id: at})
+
+    async def save_user_configuration(self, telegram_id: int, configuration: dict):
+        await self.db.set(
+            self._make_bot_key(f"users:configuration[{telegram_id}]"),
+            json.dumps(configuration),
+        )
+
+    async def get_user_configuration(self, telegram_id: int) -> dict | None:
+        if data := await self.db.get(
+            self._make_bot_key(f"users:configuration[{telegram_id}]")
+        ):
+            return json.loads(data)
+
+    async def remove_user_configuration(self, telegram_id: int):
+        await self.db.delete(self._make_bot_key(f"users:configuration[{telegram_id}]"))
+
+    async def seed_user_wakeups(self):
+        """Wake up the known users once, their real schedule is set afterwards"""
+        if user_ids := await self.get_active_user_ids():
+            now = time.time()
+            await self.db.zadd(
+                self._make_bot_key("users:wakeup"),
+                dict.fromkeys(user_ids, now),
+                nx=True,
+            )
+
+    async def claim_due_user_ids(
+        self, until: float, *, limit: int, lease: float
+    ) -> list[int]:
+        """
+        Take the users due by the given time, they are postponed by the lease,
+        so that a failed dispatch is retried later rather than right away.
+        """
+        # noinspection PyUnresolvedReferences
+        user_ids = await self.db.zrangebyscore(
+            self._make_bot_key("users:wakeup"), "-inf", until, start=0, num=limit
+        )
+        if user_ids:
+            leased_until = time.time() + lease
+            await self.db.zadd(
+                self._make_bot_key("users:wakeup"),
+                dict.fromkeys(user_ids, leased_until),
+                xx=True,
+            )
+        return [int(uid) for uid in user_ids]
+
+    def on_invalidate(self, key: str, callback: Callable[[str | None], Coroutine]):
+        """Register a callback which drops the in-process copies of the objects"""
+        self._invalidation_callbacks[key].append(callback)
+
+    async def publish_invalidation(self, key: str, id_: Any = None):
+        message = {"key": key, "id": id_ and str(id_)}
+        await self.db.publish(settings.cache_invalidation_channel, json.dumps(message))
+
+    async def invalidate(self, key: str, id_: str | None = None):
+        from app.repository.model import BaseModelRepository
+
+        for repository in vars(self).values():
+            if isinstance(repository, BaseModelRepository) and repository.key == key:
+                await repository.invalidate(id_)
+        for callback in self._invalidation_callbacks[key]:
+            await callback(id_)
+
+    async def _handle_invalidation(self, data: str):
+        try:
+            message = json.loads(data)
+        except json.JSONDecodeError:
+            # allow plain keys, e.g. `PUBLISH invalidate question`
+            message = {"key": data}
+        if not isinstance(message, dict) or "key" not in message:
+            logger.error(f"got a malformed invalidation message: {data}")
+            return
+        logger.debug(f"invalidating {message['key']} (id={message.get('id')})")
+        await self.invalidate(message["key"], message.get("id"))
+
+    def start_invalidation_listener(self):
+        """Listen once per process, however many bots it serves"""
+        if self._invalidation_listener is None or self._invalidation_listener.done():
+            self._invalidation_listener = asyncio.create_task(
+                self.listen_for_invalidations()
+            )
+
+    async def listen_for_invalidations(self):
+        channel = settings.cache_invalidation_channel
+        while True:
+            try:
+                async with self.db.pubsub() as pubsub:
+                    await pubsub.subscribe(channel)
+                    logger.info(f"listening for cache invalidations on {channel!r}")
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        try:
+                            await self._handle_invalidation(message["data"])
+                        except Exception as e:
+                            logger.error(f"error while invalidating the cache: {e}")
+            except redis.ConnectionError as e:
+                logger.error(f"lost the invalidation channel: {e}")
+                await asyncio.sleep(1)
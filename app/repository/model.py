@@ -4,7 +4,7 @@ from uuid import UUID
 from pydantic import BaseModel, TypeAdapter
 
 from app.repository.core import Repository
-from app.utils import get_logger, get_settings
+from app.utils import get_current_bot_id, get_logger, split
 
 __all__ = [
     "BaseModelRepository",
@@ -14,7 +14,6 @@ __all__ = [
 ]
 
 logger = get_logger(__file__)
-settings = get_settings()
 
 ModelClass = TypeVar("ModelClass", bound=BaseModel)
 ID = int | str | UUID | ModelClass
@@ -47,6 +46,8 @@ class BaseModelRepository(Generic[ModelClass]):
         return f"{self.key}:id[{id_}]"
 
     def _make_ref(self, kwargs: dict) -> str:
+        # the lookups like telegram_id or label are unique only within a bot
+        kwargs = {"__bot__": get_current_bot_id()} | kwargs
         ref = hash(frozenset((k, self._extract_id(v)) for k, v in kwargs.items()))
         return f"{self.key}:ref[{ref}]"
 
@@ -73,6 +74,15 @@ class BaseModelRepository(Generic[ModelClass]):
         key = self._make_key(id_, **kwargs)
         await self.core.remove_pickle(key)
 
+    async def invalidate(self, id_: ID | None = None) -> None:
+        if id_ is not None:
+            await self.remove(id_)
+            return
+        # drop every cached object of the kind, along with the lists and refs
+        keys = [key async for key in self.core.raw_db.scan_iter(f"{self.key}:*")]
+        for chunk in split(keys, 500):
+            await self.core.raw_db.delete(*chunk)
+
 
 class BaseRoModelRepository(BaseModelRepository[ModelClass]):
     url: str
@@ -96,7 +106,7 @@ class BaseRoModelRepository(BaseModelRepository[ModelClass]):
     ) -> dict | None:
         params = kwargs
         if id_ is None:
-            params["bot"] = settings.bot_id
+            params["bot"] = get_current_bot_id()
         return {"params": params}
 
     async def _retrieve(
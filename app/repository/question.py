@@ -1,6 +1,6 @@
 from app.models import Question
 from app.repository.model import ID, BaseRoModelRepository
-from app.utils import get_settings
+from app.utils import get_current_bot_id, get_settings
 
 __all__ = ["QuestionRepository"]
 
@@ -15,4 +15,6 @@ class QuestionRepository(BaseRoModelRepository[Question]):
 
     async def _get_retrieve_kwargs(self, id_: ID | None, **kwargs) -> dict | None:
         if id_ is None:
-            return {"params": {"bot": str(settings.bot_id), "label": kwargs["label"]}}
+            return {
+                "params": {"bot": str(get_current_bot_id()), "label": kwargs["label"]}
+            }
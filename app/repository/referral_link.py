@@ -1,6 +1,6 @@
 from app.models import ReferralLink
 from app.repository.model import ID, BaseRoModelRepository
-from app.utils import get_settings
+from app.utils import get_current_bot_id, get_settings
 
 __all__ = ["ReferralLinkRepository"]
 
@@ -17,5 +17,5 @@ class ReferralLinkRepository(BaseRoModelRepository[ReferralLink]):
         if id_ is None:
             alias = kwargs.get("alias")
             params = {"alias": alias} if alias else {"is_default": True}
-            params["bot"] = settings.bot_id
+            params["bot"] = get_current_bot_id()
             return {"params": params}
@@ -1,6 +1,6 @@
 from app.models import Role
 from app.repository.model import ID, BaseRoModelRepository
-from app.utils import get_settings
+from app.utils import get_current_bot_id, get_settings
 
 __all__ = ["RoleRepository"]
 
@@ -17,5 +17,5 @@ class RoleRepository(BaseRoModelRepository[Role]):
         self, id_: ID | None, *, context: dict = None, **kwargs
     ) -> dict | None:
         if id_ is None:
-            return {"params": {"bot": settings.bot_id}}
+            return {"params": {"bot": get_current_bot_id()}}
         return None
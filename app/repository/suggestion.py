@@ -1,11 +1,17 @@
+import asyncio
+import contextlib
+import time
 from uuid import UUID
 
+from redis.exceptions import LockError
+
 from app.models import Suggestion
 from app.repository.model import ID, BaseRwModelRepository
-from app.utils import get_settings
+from app.utils import get_logger, get_settings
 
 __all__ = ["SuggestionRepository"]
 
+logger = get_logger(__file__)
 settings = get_settings()
 
 
@@ -15,18 +21,128 @@ class SuggestionRepository(BaseRwModelRepository[Suggestion]):
     ex = settings.cache_ex_suggestions
     url = "/suggestions"
 
+    def __init__(self, core):
+        super().__init__(core)
+        self._refills: set[asyncio.Task] = set()
+
     async def _get_retrieve_kwargs(self, id_: ID | None, **kwargs) -> dict | None:
         if id_ is None:
             return {"params": {"owner": kwargs["user_id"]}}
 
+    def _make_queue_key(self, user_id: UUID) -> str:
+        # the candidate ids by the score, the suggestions are in the payloads hash
+        return f"{self.key}:queue[{user_id}]"
+
+    def _make_payloads_key(self, user_id: UUID) -> str:
+        return f"{self.key}:payloads[{user_id}]"
+
+    def _make_served_key(self, user_id: UUID) -> str:
+        return f"{self.key}:served[{user_id}]"
+
+    def _make_refill_key(self, user_id: UUID) -> str:
+        return f"{self.key}:refill[{user_id}]"
+
+    def _make_exhausted_key(self, user_id: UUID) -> str:
+        return f"{self.key}:exhausted[{user_id}]"
+
+    async def refill(self, user_id: UUID) -> int | None:
+        """The number of the queued suggestions, None if another refill is running"""
+        if await self.core.db.exists(self._make_exhausted_key(user_id)):
+            # the backend has had nothing new recently
+            return 0
+        # the lock prevents parallel refills for the same user
+        lock = self.core.db.lock(self._make_refill_key(user_id), timeout=30)
+        if not await lock.acquire(blocking=False):
+            return None
+        try:
+            suggestions = await self._retrieve(user_id=user_id, many=True) or []
+            served = await self.core.db.smembers(self._make_served_key(user_id))
+            # a candidate is queued once, however its score changes meanwhile
+            by_candidate = {
+                str(suggestion.candidate): suggestion
+                for suggestion in suggestions
+                if str(suggestion.candidate) not in served
+            }
+            added = 0
+            if by_candidate:
+                queue_key = self._make_queue_key(user_id)
+                payloads_key = self._make_payloads_key(user_id)
+                async with self.core.db.pipeline(transaction=True) as pipe:
+                    for candidate, suggestion in by_candidate.items():
+                        pipe.hsetnx(
+                            payloads_key, candidate, suggestion.model_dump_json()
+                        )
+                    pipe.zadd(
+                        queue_key,
+                        {c: s.score for c, s in by_candidate.items()},
+                        nx=True,
+                    )
+                    pipe.expire(queue_key, self.ex)
+                    pipe.expire(payloads_key, self.ex)
+                    *_, added, _, _ = await pipe.execute()
+            if not added:
+                await self.core.db.set(
+                    self._make_exhausted_key(user_id),
+                    1,
+                    ex=settings.cache_ex_suggestions_exhausted,
+                )
+            return added
+        finally:
+            # the lock might have expired and been taken by another worker
+            with contextlib.suppress(LockError):
+                await lock.release()
+
+    async def _wait_for_refill(self, user_id: UUID):
+        deadline = time.monotonic() + settings.suggestions_refill_timeout
+        refill_key = self._make_refill_key(user_id)
+        while time.monotonic() < deadline and await self.core.db.exists(refill_key):
+            await asyncio.sleep(0.1)
+
+    def _refill_in_background(self, user_id: UUID):
+        async def refill():
+            try:
+                await self.refill(user_id)
+            except Exception as e:
+                logger.error(f"could not refill the suggestions of {user_id}: {e}")
+
+        task = asyncio.create_task(refill())
+        self._refills.add(task)
+        task.add_done_callback(self._refills.discard)
+
+    async def _pop(self, user_id: UUID) -> tuple[Suggestion | None, int]:
+        queue_key = self._make_queue_key(user_id)
+        payloads_key = self._make_payloads_key(user_id)
+        served_key = self._make_served_key(user_id)
+        while True:
+            async with self.core.db.pipeline(transaction=True) as pipe:
+                pipe.zpopmax(queue_key)
+                pipe.zcard(queue_key)
+                popped, remaining = await pipe.execute()
+            if not popped:
+                return None, remaining
+            # the popped candidate belongs to this worker only
+            candidate, _ = popped[0]
+            async with self.core.db.pipeline(transaction=False) as pipe:
+                pipe.hget(payloads_key, candidate)
+                pipe.hdel(payloads_key, candidate)
+                data, _ = await pipe.execute()
+            if data is None:
+                # the payload has expired, the candidate is refilled if still due
+                continue
+            async with self.core.db.pipeline(transaction=False) as pipe:
+                pipe.sadd(served_key, candidate)
+                pipe.expire(served_key, settings.cache_ex_suggestions_served)
+                await pipe.execute()
+            return Suggestion.model_validate_json(data), remaining
+
     async def pop(self, user_id: UUID) -> Suggestion | None:
-        suggestions: list[Suggestion] | None = await self.get(
-            user_id=user_id, many=True
-        )
-        if suggestions:
-            suggestion = suggestions.pop()
-            if suggestions:
-                await self.save(suggestions, user_id=user_id)
-            else:
-                await self.remove([], user_id=user_id)
-            return suggestion
+        suggestion, remaining = await self._pop(user_id)
+        if suggestion is None:
+            # the queue is exhausted, so the user has to wait for the backend anyway
+            if await self.refill(user_id) is None:
+                # another worker is refilling the queue already
+                await self._wait_for_refill(user_id)
+            suggestion, remaining = await self._pop(user_id)
+        if suggestion is not None and remaining < settings.suggestions_watermark:
+            self._refill_in_background(user_id)
+        return suggestion
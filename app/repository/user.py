@@ -1,12 +1,17 @@
+import asyncio
+from typing import AsyncIterator
+
+from pydantic import TypeAdapter
 from telegram import Chat
 
 from app.exceptions import PublicError
 from app.models import User
 from app.repository.model import ID, BaseRwModelRepository
-from app.utils import get_settings
+from app.utils import get_current_bot_id, get_logger, get_settings, split
 
 __all__ = ["UserRepository"]
 
+logger = get_logger(__file__)
 settings = get_settings()
 
 
@@ -21,7 +26,7 @@ class UserRepository(BaseRwModelRepository[User]):
     ) -> dict | None:
         if id_ is None:
             kwargs.setdefault("is_active", True)
-            kwargs.setdefault("bot", settings.bot_id)
+            kwargs.setdefault("bot", get_current_bot_id())
             return {"params": kwargs}
 
     async def _get_create_kwargs(
@@ -50,3 +55,56 @@ class UserRepository(BaseRwModelRepository[User]):
                 "last_name": chat.last_name or "",
             }
         }
+
+    async def iterate(
+        self, *, offset: int = 0, page_size: int = 500, **params
+    ) -> AsyncIterator[tuple[int, list[User]]]:
+        """
+        Page through the users without caching them, yields the offset of every
+        page. A plain list instead of the {"results"} pages is taken for all of
+        the users, as the backend does not paginate them then.
+        """
+        params.setdefault("is_active", True)
+        params.setdefault("bot", get_current_bot_id())
+        # a backend ignoring the pagination must not make the same users come back
+        seen_ids = set()
+        while True:
+            response = await self.core.httpx.get(
+                f"{self.url}/",
+                params=params | {"limit": page_size, "offset": offset},
+            )
+            response.raise_for_status()
+            data = response.json() or []
+            is_paginated = isinstance(data, dict)
+            has_next = True
+            if is_paginated:
+                has_next = data.get("next", True) is not None
+                data = data.get("results") or []
+            users = [
+                user
+                for user in TypeAdapter(list[User]).validate_python(data)
+                if user.id not in seen_ids
+            ]
+            if not users:
+                return
+            seen_ids.update(user.id for user in users)
+            yield offset, users
+            if not is_paginated or not has_next or len(data) != page_size:
+                return
+            offset += len(data)
+
+    async def patch_many(self, users: list[User], **fields) -> None:
+        """Set the same fields on many users with one request"""
+        data = [{"id": str(user.id), **fields} for user in users]
+        response = await self.core.httpx.patch(f"{self.url}/", json=data)
+        if response.status_code in (404, 405):
+            # the backend does not support the bulk updates
+            logger.warning("bulk patch is not supported, patching one by one")
+            for chunk in split(users, 10):
+                await asyncio.gather(
+                    *(self.patch(user.model_copy(update=fields)) for user in chunk)
+                )
+            return
+        response.raise_for_status()
+        # the cached copies are outdated now
+        await asyncio.gather(*(self.remove(user) for user in users))
@@ -7,8 +7,6 @@ from pydantic import PostgresDsn, AnyUrl, ConfigDict
 from pydantic import SecretStr
 from pydantic_settings import BaseSettings
 
-from app.models.bot import Bot
-
 __all__ = ["Settings"]
 
 
@@ -21,10 +19,39 @@ class Settings(BaseSettings):
     project_root: Path = Path(__file__).parent.parent
     static_root: Path = project_root / "static"
 
-    bot_id: UUID
-    bot: Bot | None = None
+    # one process serves either the bot or all the bots listed
+    bot_id: UUID | None = None
+    bot_ids: list[UUID] = []
+    # the concurrent dispatches of every bot
+    bot_concurrency: int = 64
+    # the updates of different users are processed concurrently
+    concurrent_updates: int = 256
+    # the outbound limits of Telegram, per second
+    telegram_global_rate: float = 30
+    # the private chats are limited by the global rate only, like in PTB
+    telegram_group_rate: float = 20 / 60
+    telegram_group_burst: int = 20
+    telegram_max_retries: int = 3
+    # only one of the replicas should run the scheduled jobs and the bot logic
+    run_jobs: bool = True
+
+    # the public URL Telegram posts the updates to, the path is served locally
+    webhook_url: AnyUrl | None = None
+    webhook_path: str = "/telegram"
+    webhook_secret: SecretStr | None = None
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 80
+    webhook_workers: int = 64
+    webhook_queue_size: int = 10_000
+    webhook_drain_timeout: float = 30
 
     postgres_url: PostgresDsn
+    # the pool is shared by the bots, each of them holds at most
+    # bot_db_concurrency of its connections at once
+    postgres_pool_size: int = 20
+    postgres_max_overflow: int = 10
+    postgres_pool_timeout: float = 30
+    bot_db_concurrency: int = 10
     redis_url: AnyUrl
     redis_db: int
 
@@ -32,19 +59,76 @@ class Settings(BaseSettings):
     backend_api_verify: Path | bool = True
     backend_api_username: SecretStr
     backend_api_password: SecretStr
+    cache_ex_token: int = 5 * 60
 
-    cache_ex_bot: int = 60
+    # these objects are invalidated through the channel, so the TTLs are long
+    cache_invalidation_channel: str = "invalidate"
+    cache_ex_bot: int = 6 * 60 * 60
     cache_ex_account: int = 60 * 60
     cache_ex_user: int = 60 * 60
-    cache_ex_statechart: int = 60
+    cache_ex_statechart: int = 6 * 60 * 60
     cache_ex_referral_link: int = 60 * 60
     cache_ex_content: int = 60 * 60
     cache_ex_role: int = 60 * 60
-    cache_ex_question: int = 60
+    cache_ex_question: int = 6 * 60 * 60
     cache_ex_suggestions: int = 60
+    cache_ex_suggestions_served: int = 60 * 60
+    cache_ex_suggestions_exhausted: int = 30
+    suggestions_watermark: int = 5
+    suggestions_refill_timeout: float = 10
     cache_ex_answers: int = 60 * 60
     cache_ex_feedbacks: int = 60 * 60
     cache_ex_match: int = 60 * 60
+    cache_ex_callback: int = 24 * 60 * 60
+    cache_ex_profile_schema: int = 24 * 60 * 60
+    cache_ex_profile_card: int = 24 * 60 * 60
+    cache_ex_telegram_chat: int = 60 * 60
+    # the download links of the files are valid for at least an hour
+    cache_ex_telegram_file: int = 55 * 60
+    # the file ids of the uploaded photos do not expire
+    cache_ex_telegram_photo: int = 30 * 24 * 60 * 60
+
+    answers_queue_size: int = 10_000
+    answers_batch_size: int = 100
+    answers_batch_interval: float = 1
+    answers_max_retries: int = 5
+    answers_retry_delay: float = 1
+    answers_drain_timeout: float = 30
+
+    # the profile changes are flushed in bulk with a bounded lag
+    profile_write_behind: bool = False
+    profile_flush_interval: float = 1
+    profile_flush_size: int = 1000
+    # milliseconds to wait for the table lock while altering the profile tables
+    profile_ddl_lock_timeout: int = 5000
+
+    template_cache_size: int = 1024
+    markup_cache_size: int = 4096
+
+    # the users are woken up only when their statecharts have timers due
+    scheduler_tick: float = 1
+    scheduler_batch_size: int = 1000
+    scheduler_concurrency: int = 32
 
     check_user_inactivity: bool = True
     check_user_inactivity_time: datetime.time = datetime.time(hour=4)
+    # stays below the global limit of Telegram, about 30 requests a second
+    inactivity_probe_rate: float = 20
+    inactivity_probe_concurrency: int = 50
+    inactivity_probe_page_size: int = 500
+    cache_ex_inactivity_probe_cursor: int = 2 * 24 * 60 * 60
+
+    @property
+    def served_bot_ids(self) -> list[UUID]:
+        if self.bot_ids:
+            return self.bot_ids
+        if self.bot_id is None:
+            raise ValueError("Either BOT_ID or BOT_IDS has to be set")
+        return [self.bot_id]
+
+    @property
+    def single_bot_id(self) -> UUID:
+        """The bot of the entry points which serve only one"""
+        if len(bot_ids := self.served_bot_ids) != 1:
+            raise ValueError(f"Exactly one bot has to be set, got {len(bot_ids)}")
+        return bot_ids[0]
@@ -1,10 +1,27 @@
+import asyncio
 import logging
+from contextvars import ContextVar
 from functools import lru_cache
+from typing import TYPE_CHECKING
+from uuid import UUID
 
 from rich.console import Console
 from rich.logging import RichHandler
 
-__all__ = ["get_logger", "get_settings", "get_repository", "split"]
+if TYPE_CHECKING:
+    from app.models import Bot
+
+__all__ = [
+    "get_logger",
+    "get_settings",
+    "get_repository",
+    "split",
+    "BotRuntime",
+    "activate_bot",
+    "get_bot_runtime",
+    "get_current_bot",
+    "get_current_bot_id",
+]
 
 console = Console(color_system="256", width=150, style="blue")
 
@@ -36,3 +53,56 @@ def get_logger(module_name):
 
 def split(lst: list, n: int) -> list[list]:
     return [lst[i : i + n] for i in range(0, len(lst), n)]
+
+
+class BotRuntime:
+    """
+    The bot served by the current task, so that one process can serve many bots
+    sharing the pools. The config is updated in place when the bot changes.
+    """
+
+    def __init__(self, bot_id: UUID, config: "Bot | None" = None):
+        self.id = bot_id
+        self.config = config
+        settings = get_settings()
+        # the quotas of the concurrent dispatches and of the database connections,
+        # so that a busy bot does not exhaust the pools shared with the others
+        self.semaphore = asyncio.Semaphore(settings.bot_concurrency)
+        self.db_semaphore = asyncio.Semaphore(settings.bot_db_concurrency)
+
+    def make_key(self, key: str) -> str:
+        """Namespace the redis keys which are not unique across the bots"""
+        return f"bot[{self.id}]:{key}"
+
+
+_bot_runtime: ContextVar[BotRuntime | None] = ContextVar("bot_runtime", default=None)
+
+
+@lru_cache()
+def _get_default_bot_runtime() -> BotRuntime:
+    # the scripts which do not activate any bot use the one from the settings
+    return BotRuntime(get_settings().bot_id)
+
+
+def get_bot_runtime() -> BotRuntime:
+    return _bot_runtime.get() or _get_default_bot_runtime()
+
+
+def get_current_bot() -> "Bot":
+    if (config := get_bot_runtime().config) is None:
+        raise RuntimeError("No bot is active, see activate_bot")
+    return config
+
+
+def get_current_bot_id() -> UUID | None:
+    return get_bot_runtime().id
+
+
+async def activate_bot(bot_id: UUID) -> BotRuntime:
+    """Serve the bot in the current task and the tasks it creates"""
+    config = await get_repository().bots.get(bot_id)
+    if config is None:
+        raise RuntimeError(f"Bot {bot_id} does not exist")
+    runtime = BotRuntime(bot_id, config)
+    _bot_runtime.set(runtime)
+    return runtime